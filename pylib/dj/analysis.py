@@ -0,0 +1,410 @@
+# onya.dj.analysis
+'''
+Tempo & loudness analysis of audio files, for tracks with no BPM in the DB
+
+WAV & AIFF are decoded with the standard library; other formats need the
+optional soundfile package (https://pypi.org/project/soundfile/). Tempo is
+estimated by autocorrelation of a spectral-flux onset envelope. Loudness is an
+integrated, gated figure in the style of EBU R 128 / LUFS, but without the
+K-weighting filter, so read it as relative rather than broadcast-exact.
+Requires NumPy.
+
+Analysis runs on a process pool, with results cached by file (mtime, size).
+
+>>> from onya.dj.serial.serato import db
+>>> from onya.dj.analysis import analysis_cache, analyze_missing, apply_estimates
+>>> sdb = db()
+>>> sdb.load('/Volumes/Music/_Serato_/database V2')
+>>> cache = analysis_cache('/tmp/onya-analysis.cache')
+>>> results = analyze_missing(sdb.tracks, root='/Volumes/Music', cache=cache)
+>>> cache.save()
+>>> apply_estimates(sdb.tracks, results)
+'''
+
+import wave
+import struct
+
+from onya.etc.statcache import stat_cache, process_files
+
+# Analysis sample rate; audio is averaged down to roughly this
+ANALYSIS_RATE = 11025
+FRAME = 1024
+HOP = 128
+MIN_BPM, MAX_BPM = 60, 200
+# Tempo prior: log-normal around this BPM, favoring the usual octave of dance music
+PRIOR_BPM, PRIOR_OCTAVES = 120, 1.0
+# Seconds from the middle of the track used for tempo estimation
+TEMPO_WINDOW = 90
+# Sample frames decoded at a time when streaming through a file
+BLOCK_FRAMES = 1 << 18
+
+
+def _pcm_to_float(raw, sampwidth, channels, big_endian=False, unsigned=False):
+    '''
+    Convert interleaved integer PCM bytes to a mono float32 array in [-1, 1]
+    '''
+    import numpy as np
+
+    order = '>' if big_endian else '<'
+    if sampwidth == 3:
+        b = np.frombuffer(raw, dtype=np.uint8)[:len(raw) // 3 * 3].reshape(-1, 3).astype(np.int32)
+        hi, mid, lo = (b[:, 0], b[:, 1], b[:, 2]) if big_endian else (b[:, 2], b[:, 1], b[:, 0])
+        samples = ((hi << 24 | mid << 16 | lo << 8) >> 8).astype(np.float32)
+        scale = 2 ** 23
+    else:
+        dtype = {1: 'u1' if unsigned else 'i1', 2: 'i2', 4: 'i4'}[sampwidth]
+        samples = np.frombuffer(raw, dtype=order + dtype)[:len(raw) // sampwidth].astype(np.float32)
+        if unsigned:
+            samples -= 128
+        scale = 2 ** (8 * sampwidth - 1)
+    samples = samples[:len(samples) // channels * channels].reshape(-1, channels)
+    return samples.mean(axis=1) / np.float32(scale)
+
+
+class audio_source:
+    '''
+    An open audio file, read as mono float32 a stretch at a time, so long files
+    (e.g. hour-long mixes) needn't be decoded whole
+
+    rate - sample rate
+    frames - length in sample frames
+    '''
+    rate = frames = 0
+
+    def read(self, start, count):
+        '''
+        Return up to count mono samples, from frame start
+        '''
+        raise NotImplementedError
+
+    def blocks(self, count=BLOCK_FRAMES):
+        '''
+        Yield the whole file as consecutive arrays of up to count mono samples
+        '''
+        for start in range(0, self.frames, count):
+            yield self.read(start, count)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class wav_source(audio_source):
+    '''
+    Integer PCM WAV file
+    '''
+    def __init__(self, path):
+        self._wav = wave.open(path, 'rb')
+        self.rate, self.frames = self._wav.getframerate(), self._wav.getnframes()
+
+    def read(self, start, count):
+        w = self._wav
+        w.setpos(start)
+        return _pcm_to_float(w.readframes(count), w.getsampwidth(), w.getnchannels(), unsigned=w.getsampwidth() == 1)
+
+    def close(self):
+        self._wav.close()
+
+
+def _extended(b):
+    '''
+    Decode an 80-bit IEEE 754 extended precision float, as used for the AIFF sample rate
+    '''
+    exponent = ((b[0] & 0x7f) << 8 | b[1]) - 16383
+    mantissa = int.from_bytes(b[2:10], byteorder='big')
+    value = mantissa * 2.0 ** (exponent - 63)
+    return -value if b[0] & 0x80 else value
+
+
+class aiff_source(audio_source):
+    '''
+    Uncompressed AIFF/AIFF-C file
+    '''
+    def __init__(self, path):
+        self._fp = fp = open(path, 'rb')
+        try:
+            head = fp.read(12)
+            if head[:4] != b'FORM' or head[8:12] not in (b'AIFF', b'AIFC'):
+                raise ValueError(f'Not an AIFF file: {path}')
+            comm = data_start = None
+            # Find the COMM chunk & the start of the SSND sample data, skipping over the samples
+            while comm is None or data_start is None:
+                chunk = fp.read(8)
+                if len(chunk) < 8:
+                    break
+                size = int.from_bytes(chunk[4:], byteorder='big')
+                body = fp.tell()
+                if chunk[:4] == b'COMM':
+                    comm = fp.read(size)
+                elif chunk[:4] == b'SSND':
+                    offset = int.from_bytes(fp.read(4), byteorder='big')
+                    data_start, data_size = body + 8 + offset, size - 8 - offset
+                fp.seek(body + size + (size & 1))
+            if comm is None or data_start is None:
+                raise ValueError(f'Missing COMM or SSND chunk: {path}')
+            if len(comm) < 18:
+                raise ValueError(f'Truncated COMM chunk: {path}')
+            channels, _frames, bits = struct.unpack('>hIh', comm[:8])
+            if channels < 1 or not 1 <= bits <= 32:
+                raise ValueError(f'Bad AIFF format ({channels} channels of {bits} bits): {path}')
+            compression = comm[18:22] if head[8:12] == b'AIFC' else b'NONE'
+            if compression not in (b'NONE', b'sowt', b'twos'):
+                raise ValueError(f'Compressed AIFF-C ({compression}) not supported: {path}')
+            try:
+                rate = int(_extended(comm[8:18]))
+            except OverflowError:
+                rate = 0
+            if rate < 1:
+                raise ValueError(f'Bad AIFF sample rate: {path}')
+        except Exception:
+            fp.close()
+            raise
+        self.rate = rate
+        self._channels, self._width = channels, (bits + 7) // 8
+        self._big_endian = compression != b'sowt'
+        self._data_start = data_start
+        self.frames = max(0, data_size) // (self._width * channels)
+
+    def read(self, start, count):
+        frame_bytes = self._width * self._channels
+        count = max(0, min(count, self.frames - start))
+        self._fp.seek(self._data_start + start * frame_bytes)
+        return _pcm_to_float(self._fp.read(count * frame_bytes), self._width, self._channels,
+                             big_endian=self._big_endian)
+
+    def close(self):
+        self._fp.close()
+
+
+class soundfile_source(audio_source):
+    '''
+    Any format the optional soundfile package handles
+    '''
+    def __init__(self, path):
+        import soundfile
+        self._sf = soundfile.SoundFile(path)
+        self.rate, self.frames = self._sf.samplerate, self._sf.frames
+
+    def read(self, start, count):
+        self._sf.seek(start)
+        return self._sf.read(count, dtype='float32', always_2d=True).mean(axis=1)
+
+    def close(self):
+        self._sf.close()
+
+
+def open_audio(path):
+    '''
+    Return an audio_source for an audio file
+
+    WAV & AIFF use the standard library; anything else requires soundfile
+    '''
+    with open(path, 'rb') as fp:
+        magic = fp.read(12)
+    if magic[:4] == b'RIFF' and magic[8:12] == b'WAVE':
+        try:
+            return wav_source(path)
+        except wave.Error:
+            # e.g. floating point WAV; let the optional decoder have a go
+            pass
+    elif magic[:4] == b'FORM' and magic[8:12] in (b'AIFF', b'AIFC'):
+        return aiff_source(path)
+    return soundfile_source(path)
+
+
+def read_audio(path):
+    '''
+    Return (mono float32 samples, sample rate) for a whole audio file
+    '''
+    with open_audio(path) as src:
+        return src.read(0, src.frames), src.rate
+
+
+def _downsample(samples, rate):
+    '''
+    Average blocks of samples down to roughly ANALYSIS_RATE. Return (samples, new rate)
+    '''
+    factor = max(1, int(rate // ANALYSIS_RATE))
+    usable = len(samples) // factor * factor
+    return samples[:usable].reshape(-1, factor).mean(axis=1), rate / factor
+
+
+def onset_envelope(samples, rate):
+    '''
+    Spectral flux onset strength per hop. Return (envelope, envelope frame rate)
+    '''
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    if len(samples) < FRAME:
+        return np.zeros(0), rate / HOP
+    frames = sliding_window_view(samples, FRAME)[::HOP] * np.hanning(FRAME).astype(np.float32)
+    mag = np.log1p(100 * np.abs(np.fft.rfft(frames, axis=1)))
+    flux = np.maximum(np.diff(mag, axis=0), 0).sum(axis=1)
+    # Remove slow trends so autocorrelation picks up the beat, not the arrangement
+    width = max(1, int(rate / HOP))
+    trend = np.convolve(flux, np.ones(width) / width, mode='same')
+    return np.maximum(flux - trend, 0), rate / HOP
+
+
+def estimate_tempo(samples, rate):
+    '''
+    Estimate tempo in BPM from mono samples, or None if there's too little signal
+    '''
+    import numpy as np
+
+    mid, span = len(samples) // 2, int(TEMPO_WINDOW * rate / 2)
+    samples, rate = _downsample(samples[max(0, mid - span):mid + span], rate)
+    env, env_rate = onset_envelope(samples, rate)
+    if len(env) < 4 or not env.any():
+        return None
+    env = env - env.mean()
+    # Autocorrelation via FFT
+    n = 1 << int(np.ceil(np.log2(2 * len(env))))
+    spec = np.fft.rfft(env, n)
+    acf = np.fft.irfft(spec * np.conj(spec), n)[:len(env)]
+
+    lags = np.arange(len(acf), dtype=np.float64)
+    lo, hi = int(60 * env_rate / MAX_BPM), int(np.ceil(60 * env_rate / MIN_BPM))
+    if hi >= len(acf) or lo < 1:
+        return None
+    bpms = 60 * env_rate / lags[lo:hi + 1]
+    prior = np.exp(-0.5 * (np.log2(bpms / PRIOR_BPM) / PRIOR_OCTAVES) ** 2)
+    scores = acf[lo:hi + 1] * prior
+    best = int(np.argmax(scores)) + lo
+    # Parabolic interpolation around the peak for sub-frame lag precision
+    if lo < best < hi:
+        a, b, c = acf[best - 1], acf[best], acf[best + 1]
+        denom = a - 2 * b + c
+        shift = 0.5 * (a - c) / denom if denom else 0
+    else:
+        shift = 0
+    return round(float(60 * env_rate / (best + shift)), 2)
+
+
+def _step_power(blocks, step):
+    '''
+    Sum squared samples over consecutive runs of step samples, across a stream of blocks.
+    Return (array of sums for each complete run, total sum of squares, number of samples)
+    '''
+    import numpy as np
+
+    sums, total, count = [], 0.0, 0
+    carry = np.empty(0)
+    for block in blocks:
+        power = block.astype(np.float64) ** 2
+        total += float(power.sum())
+        count += len(power)
+        power = np.concatenate((carry, power))
+        usable = len(power) // step * step
+        if usable:
+            sums.append(power[:usable].reshape(-1, step).sum(axis=1))
+        carry = power[usable:]
+    return (np.concatenate(sums) if sums else np.empty(0)), total, count
+
+
+def loudness(samples, rate):
+    '''
+    Return (integrated loudness, RMS) in dB relative to full scale of mono samples,
+    or (None, None) for silence. See stream_loudness
+    '''
+    return stream_loudness([samples], rate)
+
+
+def stream_loudness(blocks, rate):
+    '''
+    Return (integrated loudness, RMS) in dB relative to full scale, or (None, None) for silence
+
+    blocks - the audio as consecutive arrays of mono samples, e.g. from audio_source.blocks()
+
+    Integrated loudness uses 400 ms blocks overlapping by 75%, an absolute gate at -70
+    & a relative gate 10 dB below the ungated level, as in EBU R 128, minus K-weighting.
+    Only power per 100 ms step is kept, so memory use doesn't grow with the audio
+    '''
+    import numpy as np
+
+    step = max(1, int(0.1 * rate))
+    steps, total, count = _step_power(blocks, step)
+    if not count or total <= 0:
+        return None, None
+    rms = 10 * np.log10(total / count)
+
+    block = 4 * step
+    if count < block:
+        return round(float(rms - 0.691), 2), round(float(rms), 2)
+    csum = np.concatenate(([0.0], np.cumsum(steps)))
+    gating_blocks = (csum[4:] - csum[:-4]) / block
+    with np.errstate(divide='ignore'):
+        levels = -0.691 + 10 * np.log10(gating_blocks)
+    gated = gating_blocks[levels > -70]
+    if not len(gated):
+        return None, round(float(rms), 2)
+    relative = -0.691 + 10 * np.log10(gated.mean()) - 10
+    gated = gated[-0.691 + 10 * np.log10(gated) > relative]
+    return round(float(-0.691 + 10 * np.log10(gated.mean())), 2), round(float(rms), 2)
+
+
+def analyze(path):
+    '''
+    Analyze one audio file. Return dict with 'bpm', 'loudness' & 'rms', or None if it can't be decoded
+
+    Only TEMPO_WINDOW seconds from the middle are read for tempo, & loudness is measured
+    a block at a time, so long files don't have to fit in memory
+    '''
+    try:
+        with open_audio(path) as src:
+            span = int(TEMPO_WINDOW * src.rate / 2)
+            start = max(0, src.frames // 2 - span)
+            bpm = estimate_tempo(src.read(start, 2 * span), src.rate)
+            lufs, rms = stream_loudness(src.blocks(), src.rate)
+    except (OSError, ValueError, ImportError, RuntimeError, wave.Error, EOFError, struct.error):
+        return None
+    return {'bpm': bpm, 'loudness': lufs, 'rms': rms}
+
+
+class analysis_cache(stat_cache):
+    '''
+    analyze() results keyed by file path, valid while the file's (mtime, size) is unchanged
+
+    path - file where the cache is pickled. If None, the cache is in memory only
+    '''
+
+
+def analyze_all(paths, root='/', cache=None, workers=None):
+    '''
+    Analyze many files on a process pool. Return dict of path to analyze() result
+    (None for files that are missing or can't be decoded)
+
+    cache - optional analysis_cache. Other arguments as for onya.etc.statcache.process_files
+    '''
+    cache = cache if cache is not None else analysis_cache()
+    # Each file is a substantial job, so one at a time
+    return process_files(analyze, paths, cache, root=root, workers=workers, batch_size=1)
+
+
+def analyze_missing(tracks, root='/', cache=None, workers=None):
+    '''
+    Analyze the audio of tracks which have no BPM (tbpm). Return dict as from analyze_all
+    '''
+    return analyze_all([ t['pfil'] for t in tracks if t.get('tbpm') is None and 'pfil' in t ],
+                       root=root, cache=cache, workers=workers)
+
+
+def apply_estimates(tracks, results):
+    '''
+    Fill in tbpm (rounded, as decoded from the DB) & loudness on tracks from analysis results.
+    BPMs already in the DB are left alone
+    '''
+    for t in tracks:
+        result = results.get(t.get('pfil'))
+        if not result:
+            continue
+        if t.get('tbpm') is None and result['bpm']:
+            t['tbpm'] = round(result['bpm'])
+        if result['loudness'] is not None:
+            t['loudness'] = result['loudness']
@@ -0,0 +1,92 @@
+# onya.dj.batch
+'''
+Answer a stream of newline-delimited JSON requests against one loaded library
+
+For scripts & pipelines which would otherwise run onya.dj once per lookup,
+re-parsing the DB every time. Each input line is a JSON object with an op &
+its arguments, plus an optional id which is echoed back. One JSON line is
+written per request, in request order:
+
+{"id": 1, "op": "search", "q": "SWV", "limit": 10}
+{"id": 2, "op": "query", "criteria": {"tgen": "House", "tbpm": [120, 128]}}
+{"id": 3, "op": "crate", "name": "House%%Deep"}
+{"id": 4, "op": "track", "path": "Music/x.mp3"}
+{"id": 5, "op": "crates"}
+
+-> {"id": 1, "result": [...]}  or  {"id": 1, "error": "...", "status": 404}
+
+Requests are answered by library.answer, as for the query service, so ops,
+limits & errors (with their HTTP-style status) are the same. Query criteria
+follow library.query: a value for an exact match, or a [low, high] pair
+(either may be null) for an inclusive range.
+
+Input is read on its own thread, so requests are answered while more are
+arriving, & output is buffered, only flushed when no more input is waiting.
+
+>>> import sys
+>>> from onya.dj.library import library
+>>> from onya.dj.batch import run
+>>> lib = library('/sdb/database V2')
+>>> lib.load()
+>>> run(lib, sys.stdin, sys.stdout)
+'''
+
+import json
+import queue
+import threading
+
+from onya.dj.library import request_error
+
+
+def respond(lib, line):
+    '''
+    Answer one input line. Return the response as a JSON line
+    '''
+    rid = None
+    try:
+        try:
+            req = json.loads(line)
+        except ValueError as e:
+            raise request_error(400, f'Malformed JSON: {e}')
+        if not isinstance(req, dict):
+            raise request_error(400, 'Request must be a JSON object')
+        rid = req.get('id')
+        resp = {'id': rid, 'result': lib.answer(req.get('op'), req, req.get('limit'))}
+    except request_error as e:
+        resp = {'id': rid, 'error': str(e), 'status': e.status}
+    except Exception as e:
+        resp = {'id': rid, 'error': repr(e), 'status': 500}
+    return json.dumps(resp) + '\n'
+
+
+def _read_lines(infile, lines):
+    try:
+        for line in infile:
+            if line.strip():
+                lines.put(line)
+    finally:
+        lines.put(None)
+
+
+def run(lib, infile, outfile):
+    '''
+    Answer requests from infile, one JSON object per line, until it ends.
+    Responses go to outfile, one per line. Return the number of requests answered
+    '''
+    lines = queue.Queue()
+    reader = threading.Thread(target=_read_lines, args=(infile, lines), daemon=True)
+    reader.start()
+    count = 0
+    while True:
+        try:
+            line = lines.get_nowait()
+        except queue.Empty:
+            # Caught up with the input, so let the consumer see what's been answered
+            outfile.flush()
+            line = lines.get()
+        if line is None:
+            break
+        outfile.write(respond(lib, line))
+        count += 1
+    outfile.flush()
+    return count
@@ -0,0 +1,222 @@
+# onya.dj.cratetree
+'''
+Serato crate hierarchy as a tree, with aggregate statistics per node
+
+Serato encodes crate nesting in .crate file names, e.g. House%%Deep%%Late.crate.
+Each node keeps stats for its own crate's tracks, plus totals including all
+descendants. When one crate changes, only the difference is pushed up its
+ancestor chain, so the whole tree never needs recomputing.
+
+>>> from onya.dj.library import library
+>>> from onya.dj.cratetree import crate_tree
+>>> lib = library('/sdb/database V2')
+>>> lib.load()
+>>> tree = crate_tree(lib.crates.values(), lib.by_path)
+>>> print(tree.render())
+'''
+
+from collections import Counter
+
+from onya.dj.serial.serato import crate
+
+DELIM = crate.HIERARCHY_DELIMITER
+
+
+def track_seconds(t):
+    '''
+    Track duration in seconds from its (decoded) tlen field, or 0 if unknown
+    '''
+    return t.get('tlen') or 0
+
+
+class crate_stats:
+    '''
+    Summary statistics over a collection of tracks
+
+    count - number of tracks
+    duration - total duration in seconds
+    bpm - histogram of BPM (rounded) to track count
+    keys - musical key to track count
+    '''
+    __slots__ = ('count', 'duration', 'bpm', 'keys')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+        self.bpm = Counter()
+        self.keys = Counter()
+
+    @staticmethod
+    def from_tracks(tracks):
+        st = crate_stats()
+        for t in tracks:
+            st.count += 1
+            st.duration += track_seconds(t)
+            if t.get('tbpm') is not None:
+                st.bpm[round(t['tbpm'])] += 1
+            if t.get('tkey'):
+                st.keys[t['tkey']] += 1
+        return st
+
+    def add(self, other, sign=1):
+        '''
+        Add other stats into these (or subtract, if sign is -1), in place
+        '''
+        self.count += sign * other.count
+        self.duration += sign * other.duration
+        for mine, theirs in ((self.bpm, other.bpm), (self.keys, other.keys)):
+            for k, n in theirs.items():
+                mine[k] += sign * n
+                if not mine[k]:
+                    del mine[k]
+
+    def __repr__(self):
+        return f'<crate_stats count={self.count} duration={self.duration:.0f}s>'
+
+
+class crate_node:
+    '''
+    One level of the crate hierarchy
+
+    name - full hierarchical name, using the Serato delimiter, e.g. 'House%%Deep'
+    crate - the crate object, or None for a level implied by a descendant's name
+        but with no .crate file of its own
+    own - stats for this crate's own tracks
+    total - stats including all descendants
+    '''
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        self.crate = None
+        self.own = crate_stats()
+        self.total = crate_stats()
+
+    @property
+    def label(self):
+        return self.name.rpartition(DELIM)[2]
+
+    def ancestry(self):
+        '''
+        Yield this node then each of its ancestors, up to and including the root
+        '''
+        node = self
+        while node is not None:
+            yield node
+            node = node.parent
+
+    def __repr__(self):
+        return f'<crate_node {self.name!r} {self.total!r}>'
+
+
+class crate_tree:
+    '''
+    Tree of crate_nodes built from crate names
+
+    crates - iterable of loaded crate objects
+    tracks_by_path - mapping from track file path to track, used to compute stats.
+        Crate entries not found there count toward track totals only
+    '''
+    def __init__(self, crates=(), tracks_by_path=None):
+        self.tracks_by_path = tracks_by_path if tracks_by_path is not None else {}
+        self.root = crate_node('')
+        self.nodes = {}
+        for cr in crates:
+            self.update(cr)
+
+    def _node(self, name):
+        '''
+        Get the node for a hierarchical name, creating it & any missing ancestors
+        '''
+        try:
+            return self.nodes[name]
+        except KeyError:
+            pass
+        parent_name, _, _ = name.rpartition(DELIM)
+        parent = self._node(parent_name) if parent_name else self.root
+        node = self.nodes[name] = parent.children[name.rpartition(DELIM)[2]] = crate_node(name, parent)
+        return node
+
+    def _crate_stats(self, cr):
+        lookup = self.tracks_by_path
+        return crate_stats.from_tracks(lookup.get(path, {}) for path in cr.tracks)
+
+    def _apply(self, node, new_own):
+        '''
+        Replace a node's own stats, pushing the difference up through its ancestors
+        '''
+        delta = crate_stats()
+        delta.add(new_own)
+        delta.add(node.own, -1)
+        node.own = new_own
+        for n in node.ancestry():
+            n.total.add(delta)
+
+    def _link(self, node):
+        '''
+        Mirror the tree structure around node onto the crate objects' parent & children attributes
+        '''
+        # Levels without a .crate file of their own are skipped over
+        def nearest_crate(n):
+            return next((a.crate for a in n.ancestry() if a is not n and a.crate is not None), None)
+
+        def crate_children(n):
+            for c in n.children.values():
+                if c.crate is not None:
+                    yield c.crate
+                else:
+                    yield from crate_children(c)
+
+        for n in node.ancestry():
+            if n.crate is not None:
+                n.crate.children = list(crate_children(n))
+                n.crate.parent = nearest_crate(n)
+        for child in crate_children(node):
+            child.parent = nearest_crate(self.nodes[child.name])
+
+    def update(self, cr):
+        '''
+        Add a crate or replace it with a changed version, updating aggregates incrementally
+        '''
+        node = self._node(cr.name)
+        node.crate = cr
+        self._apply(node, self._crate_stats(cr))
+        self._link(node)
+
+    def remove(self, name):
+        '''
+        Remove a crate's own tracks from the tree. The node itself remains if it has children
+        '''
+        node = self.nodes[name]
+        self._apply(node, crate_stats())
+        node.crate = None
+        self._link(node)
+        while node is not self.root and not node.children and node.crate is None:
+            del node.parent.children[node.label]
+            del self.nodes[node.name]
+            node = node.parent
+
+    def __getitem__(self, name):
+        return self.nodes[name]
+
+    def walk(self, node=None, depth=0):
+        '''
+        Yield (depth, node) for every node below node (default root), depth first in name order
+        '''
+        node = node or self.root
+        for label in sorted(node.children):
+            child = node.children[label]
+            yield depth, child
+            yield from self.walk(child, depth + 1)
+
+    def render(self, indent='  '):
+        '''
+        Text outline of the tree with track count, duration & commonest BPM per node
+        '''
+        lines = []
+        for depth, node in self.walk():
+            st = node.total
+            top_bpm = ', '.join(str(b) for b, _ in st.bpm.most_common(3))
+            mins = int(st.duration) // 60
+            lines.append(f'{indent * depth}{node.label} [{st.count} tracks, {mins // 60}h{mins % 60:02d}m, BPM {top_bpm or "?"}]')
+        return '\n'.join(lines)
@@ -0,0 +1,331 @@
+# onya.dj.library
+'''
+A Serato library held in memory: the DB tracks, the crates, and lookup indexes
+over them, loaded once so that many queries can be answered without re-parsing
+
+>>> from onya.dj.library import library
+>>> lib = library('/sdb/database V2')
+>>> lib.load()
+>>> lib.search('SWV', limit=10)
+'''
+
+import sys
+import struct
+import threading
+import contextlib
+from bisect import bisect_left, bisect_right
+from os.path import dirname, join
+from pathlib import Path
+
+from onya.dj.serial.serato import crate, db
+
+# Fields combined into the string each track is fuzzy-matched against
+SEARCH_FIELDS = ('tart', 'tsng', 'talb', 'tcom')
+SEARCH_DELIM = '|'
+SEARCH_SCORE_CUTOFF = 90
+
+
+class request_error(Exception):
+    '''
+    A request (see library.answer) which is malformed or names something not in the library
+
+    status - HTTP status code to report it with, e.g. 400 or 404
+    '''
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _other_form(value):
+    '''
+    Return a number as text, or numeric text as a number, or None for anything else
+    '''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, str):
+        for conv in (int, float):
+            try:
+                return conv(value)
+            except ValueError:
+                pass
+    return None
+
+
+class _muting_stream:
+    '''
+    Stands in for a standard stream, dropping writes from muted threads only
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.muted = set()
+
+    def write(self, text):
+        if threading.get_ident() in self.muted:
+            return len(text)
+        return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_muting_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def quietly():
+    '''
+    Swallow the debugging chatter the Serato parsers write to stdout & stderr
+
+    Only output from the calling thread is dropped, so e.g. a reload on a worker
+    thread doesn't hide errors reported from elsewhere in the process
+    '''
+    ident = threading.get_ident()
+    with _muting_lock:
+        for name in ('stdout', 'stderr'):
+            stream = getattr(sys, name)
+            if not isinstance(stream, _muting_stream):
+                stream = _muting_stream(stream)
+                setattr(sys, name, stream)
+            stream.muted.add(ident)
+    try:
+        yield
+    finally:
+        with _muting_lock:
+            for name in ('stdout', 'stderr'):
+                stream = getattr(sys, name)
+                if isinstance(stream, _muting_stream):
+                    stream.muted.discard(ident)
+                    if not stream.muted:
+                        setattr(sys, name, stream.stream)
+
+
+class library:
+    '''
+    Serato DB plus crates, with warm indexes
+
+    dbpath - path to the Serato 'database V2' file
+    cratedir - folder of .crate files. Defaults to the Subcrates folder next to the DB
+    workers - if more than 1, parse the DB on that many processes (see db.load_parallel)
+
+    crate_errors - crate file path -> error message, for crates which couldn't be parsed
+        in the last load. These are left out rather than failing the whole load
+    '''
+    def __init__(self, dbpath, cratedir=None, workers=None):
+        self.dbpath = str(dbpath)
+        self.workers = workers
+        self.cratedir = str(cratedir) if cratedir else join(dirname(self.dbpath), 'Subcrates')
+        self.db = None
+        self.crates = {}
+        self.crate_errors = {}
+        self._reset_indexes()
+
+    def _reset_indexes(self):
+        self.by_path = {}
+        self.crates_by_path = {}
+        self._search_strings = {}
+        self._field_indexes = {}
+        self._crate_tree = None
+
+    @property
+    def tracks(self):
+        return self.db.tracks if self.db else []
+
+    def load(self):
+        '''
+        Parse the DB & all crates, then build the indexes. Can be called again to reload
+        '''
+        sdb = db()
+        crates, crate_errors = {}, {}
+        with quietly():
+            if self.workers and self.workers > 1:
+                sdb.load_parallel(self.dbpath, workers=self.workers)
+            else:
+                sdb.load(self.dbpath)
+            if Path(self.cratedir).is_dir():
+                for fname in sorted(Path(self.cratedir).glob('*.crate')):
+                    cr = crate()
+                    try:
+                        cr.load(str(fname))
+                    except (OSError, ValueError, IndexError, struct.error) as e:
+                        crate_errors[str(fname)] = str(e) or repr(e)
+                        continue
+                    crates[cr.name] = cr
+        self.db, self.crates, self.crate_errors = sdb, crates, crate_errors
+        self._reset_indexes()
+        self.index()
+
+    def index(self):
+        '''
+        (Re)build the path, crate membership & search indexes from the loaded data
+        '''
+        for ix, t in enumerate(self.tracks):
+            if 'pfil' in t:
+                self.by_path[t['pfil']] = t
+            self._search_strings[ix] = SEARCH_DELIM.join(str(t.get(f, '')) for f in SEARCH_FIELDS)
+        for name, cr in self.crates.items():
+            for path in cr.tracks:
+                self.crates_by_path.setdefault(path, []).append(name)
+
+    @property
+    def crate_tree(self):
+        '''
+        Crate hierarchy with aggregate stats, built on first use
+        '''
+        if self._crate_tree is None:
+            from onya.dj.cratetree import crate_tree
+            self._crate_tree = crate_tree(self.crates.values(), self.by_path)
+        return self._crate_tree
+
+    def track(self, path):
+        '''
+        Return the track with the given file path (pfil), or None
+        '''
+        return self.by_path.get(path)
+
+    def track_crates(self, path):
+        '''
+        Return the names of crates containing the track with the given file path
+        '''
+        return self.crates_by_path.get(path, [])
+
+    def crate_members(self, name):
+        '''
+        Return the tracks in the named crate, in crate order. Raises KeyError for an unknown crate
+
+        Crate entries not found in the DB are returned as a stub with just the path
+        '''
+        return [ self.by_path.get(path, {'pfil': path}) for path in self.crates[name].tracks ]
+
+    def search(self, q, limit=None):
+        '''
+        Fuzzy search on artist, song, album & comment. Return matching tracks, best first
+
+        Requires fuzzywuzzy
+        '''
+        from fuzzywuzzy import fuzz, process
+        res = process.extractBests(q, self._search_strings, scorer=fuzz.partial_ratio,
+                                   score_cutoff=SEARCH_SCORE_CUTOFF, limit=limit)
+        tracks = self.tracks
+        return [ tracks[r[2]] for r in res ]
+
+    def _field_index(self, field):
+        '''
+        Return (value -> row numbers dict, sorted distinct orderable values) for field,
+        built on first use & kept until the next load
+        '''
+        try:
+            return self._field_indexes[field]
+        except KeyError:
+            pass
+        rows = {}
+        for ix, t in enumerate(self.tracks):
+            val = t.get(field)
+            if val is None:
+                continue
+            if isinstance(val, str):
+                val = val.lower()
+            rows.setdefault(val, []).append(ix)
+        numbers = sorted(v for v in rows if isinstance(v, (int, float)) and not isinstance(v, bool))
+        strings = sorted(v for v in rows if isinstance(v, str))
+        self._field_indexes[field] = rows, (numbers, strings)
+        return self._field_indexes[field]
+
+    def query(self, criteria, limit=None):
+        '''
+        Return tracks matching all criteria, in DB order
+
+        criteria - dict of field to either a value, matched exactly (case-insensitive for
+            strings), or a (low, high) pair, matched inclusively. Either end may be None.
+            A value with no exact match is also tried as text if it's a number, or as a
+            number if it's numeric text, since front ends can't always tell which a field holds
+
+        Raises:
+            ValueError: for a range with one string end & one number end
+        '''
+        matched = None
+        for field, cond in criteria.items():
+            rows, (numbers, strings) = self._field_index(field)
+            if isinstance(cond, (tuple, list)):
+                lo, hi = cond
+                if lo is not None and hi is not None and isinstance(lo, str) != isinstance(hi, str):
+                    raise ValueError(f'Range for {field} mixes strings & numbers: {lo!r}..{hi!r}')
+                probe = lo if lo is not None else hi
+                keys = strings if isinstance(probe, str) else numbers
+                if isinstance(lo, str): lo = lo.lower()
+                if isinstance(hi, str): hi = hi.lower()
+                start = 0 if lo is None else bisect_left(keys, lo)
+                end = len(keys) if hi is None else bisect_right(keys, hi)
+                hits = set()
+                for k in keys[start:end]:
+                    hits.update(rows[k])
+            else:
+                key = cond.lower() if isinstance(cond, str) else cond
+                hits = set(rows.get(key, ()))
+                if not hits:
+                    # The same value typed differently, e.g. 1999 from a query string for a text field
+                    alt = _other_form(key)
+                    if alt is not None:
+                        hits = set(rows.get(alt, ()))
+            matched = hits if matched is None else matched & hits
+            if not matched:
+                return []
+        if matched is None:
+            matched = range(len(self.tracks))
+        tracks = self.tracks
+        return [ tracks[ix] for ix in sorted(matched)[:limit] ]
+
+    def answer(self, op, params, limit=None):
+        '''
+        Answer a request by operation name, as put by the query service & batch mode,
+        so both front ends behave the same. Return the result, a list for all but track
+
+        op - one of:
+            search (param q): fuzzy search, best first
+            query (param criteria, as for query()): field match, in DB order
+            crates: names of all crates
+            crate (param name): tracks in a crate
+            track (param path): a track, plus the names of the crates it's in
+        params - dict of the op's parameters
+        limit - maximum number of list items (None or 0 for all)
+
+        Raises:
+            request_error: for an unknown op, missing or bad parameters (400),
+                or an unknown crate or track (404)
+        '''
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 0):
+            raise request_error(400, f'Bad limit: {limit!r}')
+        limit = limit or None
+
+        def param(name):
+            try:
+                return params[name]
+            except KeyError:
+                raise request_error(400, f'Missing {name} parameter for {op}')
+
+        if op == 'search':
+            return self.search(str(param('q')), limit)
+        elif op == 'query':
+            criteria = param('criteria')
+            if not isinstance(criteria, dict):
+                raise request_error(400, 'Query criteria must map fields to values or ranges')
+            try:
+                return self.query(criteria, limit)
+            except (ValueError, TypeError) as e:
+                raise request_error(400, f'Bad query criteria: {e}')
+        elif op == 'crates':
+            return sorted(self.crates)[:limit]
+        elif op == 'crate':
+            name = param('name')
+            try:
+                return self.crate_members(name)[:limit]
+            except (KeyError, TypeError):
+                raise request_error(404, f'No such crate: {name}')
+        elif op == 'track':
+            path = param('path')
+            t = self.track(path) if isinstance(path, str) else None
+            if t is None:
+                raise request_error(404, f'No such track: {path}')
+            return {'track': t, 'crates': self.track_crates(path)}
+        raise request_error(400, f'Unknown operation: {op}')
@@ -0,0 +1,165 @@
+# onya.dj.search
+'''
+As-you-type track search which narrows previous result sets
+
+Each keystroke usually extends the last query by a character. Rather than
+fuzzy-ranking the whole library again, a search_session keeps the near matches
+of recent queries in a small LRU cache & re-scores only the near matches of the
+longest cached prefix of the new query.
+
+A track can match an extended query without matching its prefix at the cutoff
+(e.g. 'abcdefghix' vs. 'abcdefghxx'), so each cached query keeps every track
+scoring at least CANDIDATE_FLOOR. Extending a query of length n by d characters
+costs at most about 100 * d / n points of partial-ratio score, so tracks scoring
+below the cutoff less that much (& a little slack) against the prefix are left
+out. When that bound falls under CANDIDATE_FLOOR, as for short queries, the
+whole library is scanned. Requires fuzzywuzzy & Pandas, like db.search.
+
+Searches can also run in the background, where starting a new one cancels
+any still in progress, so stale keystrokes are dropped.
+
+>>> from onya.dj.serial.serato import db
+>>> from onya.dj.search import search_session
+>>> sdb = db()
+>>> sdb.load('/sdb/database V2')
+>>> sess = search_session(sdb)
+>>> sess.search('Sisters')
+>>> sess.search('Sisters W')    # Only re-scores the near matches for 'Sisters'
+'''
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+SCORE_CUTOFF = 90
+# Lowest score of the near matches kept for each cached query
+CANDIDATE_FLOOR = 70
+# Candidates scored between checks for cancellation
+SCORE_BATCH = 2000
+
+
+class search_cancelled(Exception):
+    pass
+
+
+class search_session:
+    '''
+    Incremental fuzzy search over a db's tracks
+
+    sdb - loaded db
+    cache_size - number of recent queries whose matches are kept
+    columns - track data frame columns in results
+    '''
+    def __init__(self, sdb, cache_size=32, columns=('tart', 'tsng', 'talb', 'tbpm')):
+        self.db = sdb
+        self.cache_size = cache_size
+        self.columns = list(columns)
+        self._cache = OrderedDict()
+        self._choices = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _candidates(self, q):
+        '''
+        Return row numbers which could match q, from the near matches of the longest
+        cached prefix of q, or None if the whole library has to be scanned
+        '''
+        with self._lock:
+            for end in range(len(q) - 1, 0, -1):
+                near = self._cache.get(q[:end])
+                if near is None:
+                    continue
+                self._cache.move_to_end(q[:end])
+                # Lowest prefix score a match of q can have; one point of slack for rounding
+                bound = SCORE_CUTOFF - 100 * (len(q) - end) / len(q) - 1
+                if bound < CANDIDATE_FLOOR:
+                    # Shorter prefixes would give an even lower bound
+                    return None
+                return [ ix for (score, ix) in near if score >= bound ]
+        return None
+
+    def _remember(self, q, matches):
+        with self._lock:
+            self._cache[q] = matches
+            self._cache.move_to_end(q)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _processed_choices(self):
+        '''
+        The db's search strings, normalized once as fuzzywuzzy would on every search
+        '''
+        if self._choices is None:
+            from fuzzywuzzy import utils
+            self.db.track_data_frame
+            self._choices = { ix: utils.full_process(text) for (ix, text) in self.db._stdf.items() }
+        return self._choices
+
+    def matches(self, q, generation=None):
+        '''
+        Return list of (score, row number) of tracks matching q, best first
+
+        Raises:
+            search_cancelled: if another search started since this one (given its generation)
+        '''
+        from fuzzywuzzy import fuzz, utils
+
+        q = utils.full_process(q)
+        if not q:
+            return []
+        with self._lock:
+            near = self._cache.get(q)
+            if near is not None:
+                self._cache.move_to_end(q)
+        if near is None:
+            choices = self._processed_choices()
+            rows = self._candidates(q)
+            if rows is None:
+                rows = list(choices)
+            near = []
+            for start in range(0, len(rows), SCORE_BATCH):
+                if generation is not None and generation != self._generation:
+                    raise search_cancelled(q)
+                for ix in rows[start:start + SCORE_BATCH]:
+                    score = fuzz.partial_ratio(q, choices[ix])
+                    if score >= CANDIDATE_FLOOR:
+                        near.append((score, ix))
+            # Best first, then in DB order, as process.extractBests would give
+            near.sort(key=lambda m: (-m[0], m[1]))
+            self._remember(q, near)
+        return [ m for m in near if m[0] >= SCORE_CUTOFF ]
+
+    def search(self, q, limit=5, generation=None):
+        '''
+        Search for q. Return a data frame of the best limit results (None for all), like db.search
+        '''
+        hit = self.matches(q, generation)[:limit]
+        return self.db.track_data_frame.iloc[[ ix for (_, ix) in hit ]][self.columns]
+
+    def submit(self, q, limit=5):
+        '''
+        Start searching for q in the background, cancelling any search already under way.
+        Return a concurrent.futures.Future, whose result raises search_cancelled if superseded
+        '''
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+        return self._executor.submit(self.search, q, limit, generation)
+
+    def cancel(self):
+        '''
+        Cancel any background search under way
+        '''
+        with self._lock:
+            self._generation += 1
+
+    def clear(self):
+        '''
+        Forget cached matches, e.g. after reloading the DB
+        '''
+        with self._lock:
+            self._cache.clear()
+            self._choices = None
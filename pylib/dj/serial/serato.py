@@ -6,11 +6,15 @@
 
 # Note: binascii.unhexlify() & binascii.hexlify()
 
+import os
 import re
 import sys
+import mmap
+import struct
+import hashlib
 from os.path import basename, splitext, join
 
-from onya.etc.bytesutil import parseable_bytestream, parseable_bytebuffer
+from onya.etc.bytesutil import parseable_bytestream
 
 SERATO_CRATE_INDIC = '/Serato ScratchLive Crate'.encode('utf-16-be')
 SERATO_DB_INDIC = '/Serato Scratch LIVE Database'.encode('utf-16-be')
@@ -40,7 +44,7 @@ class crate:
     HIERARCHY_DELIMITER = '%%'
 
     def __init__(self):
-        self.version = self.sort = self.sort_rev = self.name = self.children = None
+        self.version = self.sort = self.sort_rev = self.name = self.parent = self.children = None
         self.tracks = []
         self.columns = ['song', 'artist', 'album', 'length']
 
@@ -240,9 +244,6 @@ import functools
 # Dispatch tables of known top-level sections
 TOP_SECTION = {}
 
-# Dispatch tables of known DB sections
-OTRK_FIELD = {}
-
 def handle_section(bs):
     '''
     Determine the current section, and return a handler function, if known
@@ -306,88 +307,306 @@ def otrk(data):
     '''
     pass
 
-@handler(b'ttyp', OTRK_FIELD)
-def ttyp(data):
+# otrk field decoders. Each takes the raw field bytes & returns a native value,
+# or None if the value can't be interpreted (in which case the field is omitted)
+
+def text(data):
+    'UTF-16 text'
+    return data.decode('utf-16-be')
+
+def uint32(data):
+    'Big-endian unsigned integer'
+    return int.from_bytes(data, byteorder='big')
+
+def boolean(data):
+    'Single byte flag. Empty data is treated as missing'
+    return data != b'\x00' if data else None
+
+def timestamp(data):
+    'Big-endian unsigned integer seconds since the Unix epoch'
+    return int.from_bytes(data, byteorder='big')
+
+NUMBER_PAT = re.compile(r'\s*(\d+(?:\.\d*)?)\s*([a-zA-Z]*)')
+DURATION_PAT = re.compile(r'(?:(\d+):)?(\d+):(\d+(?:\.\d*)?)$')
+SIZE_UNITS = {'': 1, 'b': 1, 'kb': 1024, 'mb': 1024**2, 'gb': 1024**3}
+
+def _number_text(data):
     '''
-    Track type (mp3, wav, flac, etc.)
+    Return (number, unit suffix lowercased) from UTF-16 text such as '8.2MB', or (None, None)
     '''
-    return data.decode('utf-16-be')
+    m = NUMBER_PAT.match(data.decode('utf-16-be'))
+    return (float(m.group(1)), m.group(2).lower()) if m else (None, None)
+
+def text_int(data):
+    'UTF-16 text of an integer, e.g. a year or epoch timestamp'
+    num, _ = _number_text(data)
+    return None if num is None else int(num)
+
+def text_bpm(data):
+    'UTF-16 text of BPM, e.g. "128.00", rounded to whole beats'
+    num, _ = _number_text(data)
+    return None if num is None else round(num)
+
+def text_bitrate(data):
+    'UTF-16 text of bit rate, e.g. "320.0kbps", as kbps'
+    num, _ = _number_text(data)
+    return None if num is None else round(num)
+
+def text_sample_rate(data):
+    'UTF-16 text of sample rate, e.g. "44.1k", as Hz'
+    num, unit = _number_text(data)
+    if num is None:
+        return None
+    return round(num * 1000) if unit.startswith('k') else round(num)
 
-@handler(b'pfil', OTRK_FIELD)
-def pfil(data):
+def text_size(data):
+    'UTF-16 text of file size, e.g. "8.2MB", as bytes'
+    num, unit = _number_text(data)
+    if num is None or unit not in SIZE_UNITS:
+        return None
+    return round(num * SIZE_UNITS[unit])
+
+def text_duration(data):
+    'UTF-16 text of duration, e.g. "03:45.12", as seconds'
+    m = DURATION_PAT.match(data.decode('utf-16-be').strip())
+    if not m:
+        return None
+    hours, mins, secs = m.groups()
+    return int(hours or 0) * 3600 + int(mins) * 60 + float(secs)
+
+
+# Declarative schema of known otrk fields: tag -> (decoder, description)
+# Some wisdom from https://github.com/crobinso/scratchlivedb
+OTRK_SCHEMA = {
+    b'ttyp': (text, 'track type (mp3, wav, flac, etc.)'),
+    b'pfil': (text, 'full path to audio file on disk'),
+    b'tsng': (text, 'track song title'),
+    b'tart': (text, 'track artist'),
+    b'talb': (text, 'track album'),
+    b'tgen': (text, 'track genre'),
+    b'tcom': (text, 'track comment'),
+    b'tcmp': (text, 'track composer'),
+    b'tgrp': (text, 'track grouping'),
+    b'tkey': (text, 'track musical key'),
+    b'tlbl': (text, 'track release label'),
+    b'trmx': (text, 'track remixer'),
+    b'tcor': (text, 'track corruption explanation (plain text)'),
+    b'tlen': (text_duration, 'track length (time), in seconds'),
+    b'tsiz': (text_size, 'track file size, in bytes'),
+    b'tbit': (text_bitrate, 'track bit rate, in kbps'),
+    b'tsmp': (text_sample_rate, 'track sample rate, in Hz'),
+    b'tbpm': (text_bpm, 'track BPM'),
+    b'ttyr': (text_int, 'track year'),
+    b'tadd': (text_int, 'track date added, seconds since epoch'),
+    b'uadd': (timestamp, 'track date added'),
+    b'utme': (timestamp, 'track file modification time'),
+    b'utkn': (uint32, 'track number'),
+    b'udsc': (uint32, 'disc number'),
+    b'ulbl': (uint32, 'track color'),
+    b'ufsb': (uint32, 'track file size, in bytes'),
+    b'bmis': (boolean, 'track file missing'),
+    b'bply': (boolean, 'track played'),
+    b'blop': (boolean, 'track loop'),
+    b'bitu': (boolean, 'track from iTunes'),
+    b'bovc': (boolean, 'track overview calculated'),
+    b'bcrt': (boolean, 'track corrupt'),
+    b'biro': (boolean, 'track file read-only'),
+    b'bwlb': (boolean, 'track whitelisted'),
+    b'bwll': (boolean, 'track whitelisted (alternate)'),
+    b'buns': (boolean, 'track unsupported'),
+    b'bbgl': (boolean, 'track beatgrid locked'),
+    b'bkrk': (boolean, 'track key analyzed'),
+    b'bhrt': (boolean, 'track has art'),
+    b'bstm': (boolean, 'track is a stem'),
+}
+
+# Fields not in the schema are decoded by the type their tag's first letter signals
+TYPE_PREFIX = {ord('t'): text, ord('p'): text, ord('u'): uint32, ord('s'): uint32, ord('b'): boolean}
+
+# Dispatch table of known DB fields, precompiled from the schema: tag -> (field name, decoder)
+OTRK_FIELD = { tag: (tag.decode('ascii'), dec) for (tag, (dec, _)) in OTRK_SCHEMA.items() }
+
+FIELD_HEAD = struct.Struct('>4sI')
+
+
+def decode_otrk(raw, unknown=None):
     '''
-    full path to audio file on disk
+    Decode the fields of one otrk record into a dict of native values
+
+    raw - bytes (or bytes-like) of the record body, i.e. after the otrk tag & length
+    unknown - optional set, to which tags of undecodable fields are added
     '''
-    return data.decode('utf-16-be')
+    t = {}
+    field_head = FIELD_HEAD.unpack_from
+    dispatch = OTRK_FIELD.get
+    pos, end = 0, len(raw)
+    while pos + 8 <= end:
+        key, datalen = field_head(raw, pos)
+        start = pos + 8
+        pos = start + datalen
+        data = bytes(raw[start:pos])
+        entry = dispatch(key)
+        if entry:
+            name, dec = entry
+        else:
+            # Fall back to the tag's type prefix, leaving the dispatch table as built from the schema
+            dec = TYPE_PREFIX.get(key[0])
+            if not dec:
+                if unknown is not None: unknown.add(key)
+                continue
+            name = key.decode('ascii', 'replace')
+        try:
+            val = dec(data)
+        except (ValueError, UnicodeDecodeError):
+            if unknown is not None: unknown.add(key)
+            continue
+        if val is not None:
+            t[name] = val
+    return t
 
-@handler(b'tart', OTRK_FIELD)
-def tart(data):
-    'track artist'
-    return data.decode('utf-16-be')
 
-@handler(b'tsng', OTRK_FIELD)
-def tsng(data):
-    'track song title'
-    return data.decode('utf-16-be')
 
-@handler(b'talb', OTRK_FIELD)
-def talb(data):
-    'track album'
-    return data.decode('utf-16-be')
+def record_digest(raw):
+    '''
+    Content hash of an otrk record's raw bytes
+    '''
+    return hashlib.blake2b(raw, digest_size=16).digest()
 
-@handler(b'tcom', OTRK_FIELD)
-def tcom(data):
-    'track composer'
-    return data.decode('utf-16-be')
 
-@handler(b'tlen', OTRK_FIELD)
-def tlen(data):
-    'track length'
-    return data.decode('utf-16-be')
+def record_pfil(raw):
+    '''
+    Return the file path (pfil) of an otrk record, without decoding any other field, or None
+    '''
+    field_head = FIELD_HEAD.unpack_from
+    pos, end = 0, len(raw)
+    while pos + 8 <= end:
+        key, datalen = field_head(raw, pos)
+        if key == b'pfil':
+            return bytes(raw[pos + 8:pos + 8 + datalen]).decode('utf-16-be')
+        pos += 8 + datalen
+    return None
 
-@handler(b'tbit', OTRK_FIELD)
-def tbit(data):
-    'track bit rate'
-    return data.decode('utf-16-be')
 
-@handler(b'tbpm', OTRK_FIELD)
-def tbpm(data):
-    'track BPM'
-    return data.decode('utf-16-be')
+def db_header(buf):
+    '''
+    Check the DB header at the start of buf (bytes-like). Return (version, offset of first section)
 
-@handler(b'tlen', OTRK_FIELD)
-def tlen(data):
-    'track length (time)'
-    return data.decode('utf-16-be')
+    Raises:
+        ValueError: if buf doesn't start with a Serato DB header
+    '''
+    if buf[:6] != b'vrsn\x00\x00' or buf[14:14 + len(SERATO_DB_INDIC)] != SERATO_DB_INDIC:
+        raise ValueError('Not a Serato database file')
+    # As in db.load, the version is read from the 8 bytes after 'vrsn\x00\x00'
+    return bytes(buf[6:14]).decode('utf-16-be'), 14 + len(SERATO_DB_INDIC)
 
-@handler(b'ttyr', OTRK_FIELD)
-def ttyr(data):
-    'track year'
-    return data.decode('utf-16-be')
 
-@handler(b'tsiz', OTRK_FIELD)
-def tsiz(data):
-    'track size'
-    return data.decode('utf-16-be')
+def otrk_records(buf, pos=0, end=None):
+    '''
+    Hop over top-level section length prefixes in buf (bytes-like, e.g. an mmap), from pos
+    to end (default end of buf), without decoding anything. Yield (offset, length) of each
+    otrk record body
 
-@handler(b'tsmp', OTRK_FIELD)
-def tsmp(data):
-    'track sample rate'
-    return data.decode('utf-16-be')
+    Stops at end, or at a section truncated by it
+    '''
+    field_head = FIELD_HEAD.unpack_from
+    end = len(buf) if end is None else end
+    while pos + 8 <= end:
+        key, datalen = field_head(buf, pos)
+        start = pos + 8
+        pos = start + datalen
+        if pos > end:
+            break
+        if key == b'otrk':
+            yield start, datalen
+
+
+def snapshot(path):
+    '''
+    Scan a Serato DB file without decoding records. Return dict of
+    pfil -> (record digest, offset, length)
 
-@handler(b'tcor', OTRK_FIELD)
-def tcor(data):
-    'track corruption explanation (plain text)'
-    return data.decode('utf-16-be')
+    Raises:
+        ValueError: if the file isn't a Serato DB (including an empty file)
+    '''
+    with open(path, 'rb') as fp:
+        # mmap can't map an empty file
+        if not os.fstat(fp.fileno()).st_size:
+            raise ValueError('Not a Serato database file')
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            _, pos = db_header(buf)
+            snap = {}
+            for start, length in otrk_records(buf, pos):
+                raw = buf[start:start + length]
+                pfil = record_pfil(raw)
+                if pfil is not None:
+                    snap[pfil] = (record_digest(raw), start, length)
+    return snap
+
+
+def changed_fields(old, new):
+    '''
+    Return dict of field -> (old value, new value) for fields which differ between two tracks
+    '''
+    return { k: (old.get(k), new.get(k)) for k in old.keys() | new.keys() if old.get(k) != new.get(k) }
+
+
+def db_changes(old_path, new_path):
+    '''
+    Compare two Serato DB files (e.g. nightly backups) by record content hash.
+    Yield (kind, old track, new track) with kind one of 'added', 'removed' or 'changed';
+    the track for the side where it's absent is None. Only records reported are decoded
+
+    Raises:
+        ValueError: if either file isn't a Serato DB
+
+    >>> for kind, old, new in db_changes('database V2.bak', 'database V2'):
+    ...     print(kind, old or new)
+    '''
+    old_snap, new_snap = snapshot(old_path), snapshot(new_path)
+    with open(old_path, 'rb') as ofp, mmap.mmap(ofp.fileno(), 0, access=mmap.ACCESS_READ) as obuf, \
+            open(new_path, 'rb') as nfp, mmap.mmap(nfp.fileno(), 0, access=mmap.ACCESS_READ) as nbuf:
+        def decoded(buf, entry):
+            _, start, length = entry
+            return track(decode_otrk(buf[start:start + length]))
+
+        for pfil, entry in new_snap.items():
+            old_entry = old_snap.get(pfil)
+            if old_entry is None:
+                yield 'added', None, decoded(nbuf, entry)
+            elif old_entry[0] != entry[0]:
+                yield 'changed', decoded(obuf, old_entry), decoded(nbuf, entry)
+        for pfil, entry in old_snap.items():
+            if pfil not in new_snap:
+                yield 'removed', decoded(obuf, entry), None
+
+
+
+def decode_records(buf, pos, end):
+    '''
+    Decode the otrk records in buf between pos & end, which must be on record boundaries.
+    Return (list of track field dicts, list of (pfil, digest), set of unknown field tags)
+    '''
+    tracks, hashes, unknown = [], [], set()
+    for start, length in otrk_records(buf, pos, end):
+        raw = buf[start:start + length]
+        t = decode_otrk(raw, unknown)
+        tracks.append(t)
+        if 'pfil' in t:
+            hashes.append((t['pfil'], record_digest(raw)))
+    return tracks, hashes, unknown
+
+
+# Memory map of the DB file, opened once in each worker process of db.load_parallel
+_worker_buf = None
+
+def _init_worker(path):
+    global _worker_buf
+    with open(path, 'rb') as fp:
+        _worker_buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _decode_chunk(bounds):
+    return decode_records(_worker_buf, *bounds)
 
-# tadd :  track date added
-# tcom :  track comment
-# tgen :  track genre
-# tgrp :  track grouping
-# tkey :  track musical key
-# tlbl :  track release label
-# tlen :  track 
-# trmx :  track remixer
 
 class db:
     '''
@@ -406,6 +625,10 @@ class db:
         self.tracks = []
         #self.columns = ['song', 'artist', 'album', 'length']
         self.columns = set()
+        # Tags of otrk fields encountered which could not be decoded
+        self.unknown_fields = set()
+        # Content hash of each otrk record's raw bytes, keyed by pfil
+        self.hashes = {}
 
     def __str__(self):
         '''
@@ -442,31 +665,100 @@ class db:
                 break
             if key != b'otrk':
                 print(f'Unknown section: "{key}"', file=sys.stderr)
-            t = self.load_track(parseable_bytebuffer(raw_data))
+            t = self.load_track(raw_data)
             self.tracks.append(track(t))
+            if 'pfil' in t:
+                self.hashes[t['pfil']] = record_digest(raw_data)
 
         fp.close()
+        for key in sorted(self.unknown_fields):
+            print(f'UNKNOWN field: "{key}"', file=sys.stderr)
 
-    def load_track(self, data):
-        t = {}
-        while not data.exhausted:
-            key, raw_val = lookup_field(data)
-            if key in OTRK_FIELD:
-                func = OTRK_FIELD[key]
-                val = func(raw_val)
-                print(f'"{key}", value "{val}"', file=sys.stderr)
-                t[key.decode('utf-8')] = val
+    def load_parallel(self, path, workers=None, chunks_per_worker=4):
+        '''
+        Load from Serato DB file, decoding on a process pool. Gives the same tracks as load()
+
+        A cheap first pass hops over the otrk length prefixes to find record boundaries.
+        The records are then split into contiguous chunks, decoded by worker processes
+        which each memory-map the file, & merged in the original order
+
+        Args:
+            path (str): Path to the DB file
+            workers (int): Number of worker processes (default: one per core)
+            chunks_per_worker (int): More chunks balance load better, at some cost in overhead
+
+        Raises:
+            ValueError: Catch-all for parsing problems while loading the DB
+        '''
+        from concurrent.futures import ProcessPoolExecutor
+
+        workers = workers or os.cpu_count() or 1
+        with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            self.version, pos = db_header(buf)
+            # Record header offsets, plus the end of the last record
+            bounds = [ start - 8 for (start, _) in otrk_records(buf, pos) ]
+            if bounds:
+                last = bounds[-1]
+                bounds.append(last + 8 + int.from_bytes(buf[last + 4:last + 8], byteorder='big'))
+
+            if len(bounds) < 2:
+                # No records
+                chunks = []
             else:
-                if key == b'':
-                    break
-                print(f'UNKNOWN field: "{key}", value "{raw_val}"', file=sys.stderr)
-        if 'tbpm' in t:
-            t['tbpm'] = round(float(t['tbpm']))
-        # t['tbpm'] = f'{float(t.get("tbpm", "0")):.0f}'
-        # t['tbpm'] = '?' if t['tbpm'] == '0' else t['tbpm']
-        # t['enc'] = f'{{{t.get("tbpm", "?").partition(".")[0]}, {t.get("ttyp", "?")}}}'
-        # print(f'TRACKINFO: "{t}"', file=sys.stderr)
-        return t
+                nchunks = max(1, min(workers * chunks_per_worker, len(bounds) - 1))
+                step = -(-(len(bounds) - 1) // nchunks)
+                chunks = [ (bounds[i], bounds[min(i + step, len(bounds) - 1)])
+                           for i in range(0, len(bounds) - 1, step) ]
+
+            if workers == 1 or len(chunks) < 2:
+                results = [ decode_records(buf, *c) for c in chunks ]
+            else:
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(path,)) as pool:
+                    results = list(pool.map(_decode_chunk, chunks))
+
+        for tracks, hashes, unknown in results:
+            self.tracks.extend(track(t) for t in tracks)
+            self.hashes.update(hashes)
+            self.unknown_fields |= unknown
+        for key in sorted(self.unknown_fields):
+            print(f'UNKNOWN field: "{key}"', file=sys.stderr)
+
+    def load_track(self, data):
+        '''
+        Decode one otrk record body (bytes) into a dict of field name to native value
+        '''
+        return decode_otrk(data, self.unknown_fields)
+
+    def changes_from(self, older):
+        '''
+        Compare with an older loaded db by record content hash, like db_changes()
+        Yield (kind, old track, new track) with kind one of 'added', 'removed' or 'changed'
+        '''
+        old_tracks = { t['pfil']: t for t in older.tracks if 'pfil' in t }
+        new_tracks = { t['pfil']: t for t in self.tracks if 'pfil' in t }
+        for pfil, digest in self.hashes.items():
+            old_digest = older.hashes.get(pfil)
+            if old_digest is None:
+                yield 'added', None, new_tracks[pfil]
+            elif old_digest != digest:
+                yield 'changed', old_tracks[pfil], new_tracks[pfil]
+        for pfil in older.hashes:
+            if pfil not in self.hashes:
+                yield 'removed', old_tracks[pfil], None
+
+    def similar(self, t, k=10, approximate=False):
+        '''
+        Return up to k tracks most like track t by BPM, key, year, genre, label & duration,
+        nearest first. See onya.dj.similar. Requires NumPy
+
+        approximate - scan only nearby clusters of tracks, for speed on very large libraries
+        '''
+        try:
+            index = self._similarity
+        except AttributeError:
+            from onya.dj.similar import similarity_index
+            index = self._similarity = similarity_index(self.tracks)
+        return [ match for (match, _) in index.similar(t, k, approximate=approximate) ]
 
     @property
     def track_data_frame(self):
@@ -513,5 +805,5 @@ class db:
 class track(dict):
     def __str__(self):
         return f'{self.get("tart", "")} - {self.get("tsng", "")} - {self.get("talb", "")} \
-{{{self.get("tbpm", "?").partition(".")[0]}, {self.get("ttyp", "?")}}}'
+{{{self.get("tbpm", "?")}, {self.get("ttyp", "?")}}}'
 
@@ -0,0 +1,273 @@
+# onya.dj.serial.serato_history
+# Read Serato play history session files
+# Includes some wisdom gleaned from https://github.com/Holzhaus/serato-tags
+#      & https://github.com/whatsnowplaying/whats-now-playing
+
+'''
+Serato writes one file per DJ session under _Serato_/History/Sessions, in the
+same tag/length/value family as crates & the DB: a vrsn header, an oses section
+with session info, then an oent section per track loaded on a deck. Each
+section wraps an adat section, whose fields are keyed by 4-byte numbers rather
+than letter tags.
+
+history_index keeps per-file checkpoints, so on later runs only new or grown
+session files are parsed, & maintains play counts & last-played times.
+
+>>> from datetime import datetime
+>>> from onya.dj.serial.serato import db
+>>> from onya.dj.serial.serato_history import history_index
+>>> sdb = db()
+>>> sdb.load('/sdb/database V2')
+>>> hist = history_index('/tmp/serato-history.index')
+>>> hist.update('/sdb/History/Sessions')
+>>> hist.save()
+>>> hist.join(sdb.tracks)
+>>> hist.most_played(since=datetime(2026, 10, 1).timestamp())
+'''
+
+import os
+import pickle
+import bisect
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from onya.etc.bytesutil import parseable_bytestream, parseable_bytebuffer
+from onya.dj.serial.serato import lookup_field
+
+
+def _text(data):
+    return data.decode('utf-16-be').rstrip('\x00')
+
+def _uint(data):
+    return int.from_bytes(data, byteorder='big')
+
+def _flag(data):
+    return data[:1] not in (b'', b'\x00')
+
+
+# adat field number -> (field name, decoder)
+ADAT_FIELD = {
+    1: ('row', _uint),
+    2: ('pfil', _text),
+    6: ('tsng', _text),
+    7: ('tart', _text),
+    8: ('talb', _text),
+    9: ('tgen', _text),
+    15: ('tbpm', _text),
+    28: ('start', _uint),
+    29: ('end', _uint),
+    31: ('deck', _uint),
+    45: ('playtime', _uint),
+    48: ('session', _uint),
+    50: ('played', _flag),
+    51: ('tkey', _text),
+}
+
+
+def read_adat(data):
+    '''
+    Decode the fields of an adat section body (bytes) that are in ADAT_FIELD
+    '''
+    fields = {}
+    buf = parseable_bytebuffer(data)
+    while True:
+        key, val = lookup_field(buf)
+        if not key:
+            break
+        entry = ADAT_FIELD.get(int.from_bytes(key, byteorder='big'))
+        if entry:
+            name, dec = entry
+            fields[name] = dec(val)
+    return fields
+
+
+def _adat_of(section):
+    '''
+    Return the decoded adat within an oses or oent section body
+    '''
+    key, val = lookup_field(parseable_bytebuffer(section))
+    return read_adat(val) if key == b'adat' else {}
+
+
+def read_session(path):
+    '''
+    Stream through a session file. Return (session info dict, list of entry dicts), in file order
+    '''
+    info, entries = {}, []
+    with open(path, 'rb') as fp:
+        s = parseable_bytestream(fp)
+        while not s.exhausted:
+            key, val = lookup_field(s)
+            if not key:
+                break
+            if key == b'oent':
+                entries.append(_adat_of(val))
+            elif key == b'oses':
+                info = _adat_of(val)
+    return info, entries
+
+
+def read_plays(path):
+    '''
+    Return list of (start time, track path) for entries of a session file which were played.
+    Paths are made relative to the volume root, to match pfil in the DB
+    '''
+    try:
+        _, entries = read_session(path)
+    except (OSError, ValueError, UnicodeDecodeError):
+        return []
+    return [ (e['start'], e['pfil'].lstrip('/')) for e in entries
+             if e.get('played', True) and 'start' in e and e.get('pfil') ]
+
+
+class history_index:
+    '''
+    Play counts & last-played times across all session files, updated incrementally
+
+    path - file where the index is pickled. If None, it's in memory only
+
+    checkpoints - session file name -> (mtime, size) when last parsed
+    plays_by_file - session file name -> list of (start time, track path)
+    play_count - track path -> number of plays
+    last_played - track path -> start time of latest play
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.checkpoints = {}
+        self.plays_by_file = {}
+        self.play_count = Counter()
+        self.last_played = {}
+        self.tracks_by_path = {}
+        self._timeline = None
+        if path and os.path.exists(path):
+            with open(path, 'rb') as fp:
+                self.checkpoints, self.plays_by_file = pickle.load(fp)
+            for plays in self.plays_by_file.values():
+                self._count(plays, 1)
+
+    def save(self):
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as fp:
+                pickle.dump((self.checkpoints, self.plays_by_file), fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+
+    def _count(self, plays, sign):
+        '''
+        Add (sign 1) or take away (sign -1) plays from the counts. Taking plays away
+        leaves last_played to _settle, so it's recomputed once per update
+        '''
+        for start, path in plays:
+            self.play_count[path] += sign
+            if sign > 0:
+                if start > self.last_played.get(path, 0):
+                    self.last_played[path] = start
+            elif self.play_count[path] <= 0:
+                del self.play_count[path]
+
+    def _settle(self, affected):
+        '''
+        Recompute last_played for tracks (paths) which lost plays, in one pass over what remains
+        '''
+        if not affected:
+            return
+        latest = {}
+        for plays in self.plays_by_file.values():
+            for start, path in plays:
+                if path in affected and start > latest.get(path, 0):
+                    latest[path] = start
+        for path in affected:
+            if path in latest:
+                self.last_played[path] = latest[path]
+            else:
+                self.last_played.pop(path, None)
+
+    def update(self, sessions_dir, workers=None):
+        '''
+        Parse session files which are new or changed since their checkpoint, on a process pool.
+        Return the number of files parsed
+
+        Raises:
+            FileNotFoundError: if sessions_dir isn't a folder (e.g. its volume isn't mounted),
+                rather than forgetting every session
+        '''
+        if not Path(sessions_dir).is_dir():
+            raise FileNotFoundError(f'No Serato sessions folder at {sessions_dir}')
+        todo = []
+        present = set()
+        for fname in Path(sessions_dir).glob('*.session'):
+            st = fname.stat()
+            stamp = (st.st_mtime_ns, st.st_size)
+            present.add(fname.name)
+            if self.checkpoints.get(fname.name) != stamp:
+                todo.append((fname, stamp))
+
+        affected = set()
+        for gone in set(self.plays_by_file) - present:
+            affected |= self._forget(gone)
+
+        if todo:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parsed = pool.map(read_plays, [ str(f) for (f, _) in todo ], chunksize=16)
+                for (fname, stamp), plays in zip(todo, parsed):
+                    # A session still in progress grows, so replace rather than add
+                    affected |= self._forget(fname.name)
+                    self.plays_by_file[fname.name] = plays
+                    self.checkpoints[fname.name] = stamp
+                    self._count(plays, 1)
+            self._timeline = None
+        self._settle(affected)
+        return len(todo)
+
+    def _forget(self, name):
+        '''
+        Drop a session file's plays. Return the paths of tracks which lost plays, for _settle
+        '''
+        old = self.plays_by_file.pop(name, None)
+        self.checkpoints.pop(name, None)
+        if not old:
+            return set()
+        self._count(old, -1)
+        self._timeline = None
+        return { path for (_, path) in old }
+
+    @property
+    def timeline(self):
+        '''
+        All plays as (start times, track paths), sorted by time; rebuilt after updates
+        '''
+        if self._timeline is None:
+            plays = sorted(p for plays in self.plays_by_file.values() for p in plays)
+            self._timeline = ([ start for (start, _) in plays ], [ path for (_, path) in plays ])
+        return self._timeline
+
+    def join(self, tracks):
+        '''
+        Associate DB tracks (e.g. db.tracks), so query results are tracks rather than paths
+        '''
+        self.tracks_by_path = { t['pfil']: t for t in tracks if 'pfil' in t }
+
+    def _resolve(self, path):
+        return self.tracks_by_path.get(path, path)
+
+    def most_played(self, since=None, until=None, n=20):
+        '''
+        Return up to n (track, play count) pairs, most played first, counting plays
+        between since & until (Unix times, either optional). Tracks not in the joined
+        DB are returned as their path
+        '''
+        if since is None and until is None:
+            counts = self.play_count
+        else:
+            starts, paths = self.timeline
+            lo = 0 if since is None else bisect.bisect_left(starts, since)
+            hi = len(starts) if until is None else bisect.bisect_right(starts, until)
+            counts = Counter(paths[lo:hi])
+        return [ (self._resolve(path), count) for (path, count) in counts.most_common(n) ]
+
+    def plays(self, path):
+        '''
+        Return (play count, last played Unix time or None) for a track path
+        '''
+        return self.play_count.get(path, 0), self.last_played.get(path)
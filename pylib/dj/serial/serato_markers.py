@@ -0,0 +1,386 @@
+# onya.dj.serial.serato_markers
+# Read Serato cue points, loops, beatgrids & overviews from audio file tags
+# Includes some wisdom gleaned from https://github.com/Holzhaus/serato-tags
+
+'''
+Serato keeps cues, loops & beatgrids in the audio files themselves, not in
+database V2. In MP3 & AIFF/WAV files they're ID3v2 GEOB frames ("Serato Markers2",
+"Serato BeatGrid", "Serato Overview"); in FLAC they're base64 Vorbis comments
+(SERATO_MARKERS_V2, etc.). Other containers (e.g. MP4) aren't read yet, so are
+reported as unreadable.
+
+Extraction runs on a process pool, with results cached by (path, mtime, size),
+and a marker_index answers questions across the whole library without
+re-reading files.
+
+>>> from onya.dj.serial.serato import db
+>>> from onya.dj.serial.serato_markers import marker_cache, extract_all, marker_index
+>>> sdb = db()
+>>> sdb.load('/Volumes/Music/_Serato_/database V2')
+>>> cache = marker_cache('/tmp/serato-markers.cache')
+>>> markers = extract_all([t['pfil'] for t in sdb.tracks], root='/Volumes/Music', cache=cache)
+>>> cache.save()
+>>> ix = marker_index(markers)
+>>> ix.no_cues
+'''
+
+import os
+import base64
+import binascii
+import struct
+from array import array
+
+from onya.etc.statcache import stat_cache, process_files
+
+GEOB_DESCRIPTIONS = {
+    'Serato Markers2': 'markers2',
+    'Serato BeatGrid': 'beatgrid',
+    'Serato Overview': 'overview',
+}
+
+VORBIS_KEYS = {
+    'SERATO_MARKERS_V2': 'markers2',
+    'SERATO_BEATGRID': 'beatgrid',
+    'SERATO_OVERVIEW': 'overview',
+}
+
+ID3_ENCODINGS = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+
+CUE_HEAD = struct.Struct('>xBIx3s2x')
+LOOP_HEAD = struct.Struct('>xBII4s4sB?')
+BEATGRID_HEAD = struct.Struct('>BBI')
+BEATGRID_MARKER = struct.Struct('>fI')
+BEATGRID_TERMINAL = struct.Struct('>ff')
+
+
+class serato_markers:
+    '''
+    Decoded Serato tag data for one audio file, held in compact arrays
+
+    cue_slots - array of cue slot numbers (0-7)
+    cue_positions - array of cue positions in ms, parallel to cue_slots
+    cue_names - list of cue names, parallel to cue_slots
+    loops - array of loop (start, end) positions in ms, flattened
+    bpm_locked - True if the beatgrid is locked, None if not recorded
+    beatgrid - array of beatgrid marker positions in seconds
+    beatgrid_bpm - BPM from the terminal beatgrid marker, or None
+    overview - raw overview waveform bytes (16 bytes per block), or None
+    '''
+    __slots__ = ('cue_slots', 'cue_positions', 'cue_names', 'loops', 'bpm_locked',
+                 'beatgrid', 'beatgrid_bpm', 'overview')
+
+    def __init__(self):
+        self.cue_slots = array('B')
+        self.cue_positions = array('I')
+        self.cue_names = []
+        self.loops = array('I')
+        self.bpm_locked = None
+        self.beatgrid = array('f')
+        self.beatgrid_bpm = None
+        self.overview = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, a) for a in self.__slots__)
+
+    def __setstate__(self, state):
+        for a, v in zip(self.__slots__, state):
+            setattr(self, a, v)
+
+    def __repr__(self):
+        return (f'<serato_markers cues={len(self.cue_positions)} loops={len(self.loops) // 2} '
+                f'beatgrid={len(self.beatgrid)} locked={self.bpm_locked}>')
+
+
+def _cstring(data, pos, encoding='latin-1'):
+    '''
+    Return (decoded null-terminated string at pos, position after the terminator)
+    '''
+    if encoding in ('utf-16', 'utf-16-be'):
+        # Terminator is a 2-byte aligned double null
+        end = pos
+        while True:
+            end = data.find(b'\x00\x00', end)
+            if end == -1 or (end - pos) % 2 == 0:
+                break
+            end += 1
+        width = 2
+    else:
+        end = data.find(b'\x00', pos)
+        width = 1
+    if end == -1:
+        end = len(data)
+    return data[pos:end].decode(encoding, 'replace'), end + width
+
+
+def decode_markers2(payload, markers):
+    '''
+    Decode a Markers2 tag payload (after the GEOB/Vorbis header) into markers
+    '''
+    # Version bytes, then newline-wrapped base64, sometimes missing its padding
+    end = payload.find(b'\x00', 2)
+    b64 = payload[2:end if end != -1 else len(payload)].replace(b'\n', b'')
+    if len(b64) % 4 == 1:
+        b64 += b'A=='
+    else:
+        b64 += b'=' * (-len(b64) % 4)
+    data = base64.b64decode(b64)
+
+    pos = 2
+    while pos < len(data):
+        name, pos = _cstring(data, pos)
+        if not name or pos + 4 > len(data):
+            break
+        entry_len = int.from_bytes(data[pos:pos + 4], byteorder='big')
+        entry = data[pos + 4:pos + 4 + entry_len]
+        pos += 4 + entry_len
+        if name == 'CUE':
+            slot, position, _color = CUE_HEAD.unpack_from(entry)
+            markers.cue_slots.append(slot)
+            markers.cue_positions.append(position)
+            markers.cue_names.append(_cstring(entry, CUE_HEAD.size, 'utf-8')[0])
+        elif name == 'LOOP':
+            _slot, start, end, _, _, _, _locked = LOOP_HEAD.unpack_from(entry)
+            markers.loops.extend((start, end))
+        elif name == 'BPMLOCK':
+            markers.bpm_locked = bool(entry[:1] != b'\x00')
+
+
+def decode_beatgrid(payload, markers):
+    '''
+    Decode a BeatGrid tag payload into markers
+    '''
+    _, _, count = BEATGRID_HEAD.unpack_from(payload)
+    pos = BEATGRID_HEAD.size
+    for i in range(count):
+        if i == count - 1:
+            position, bpm = BEATGRID_TERMINAL.unpack_from(payload, pos)
+            markers.beatgrid_bpm = round(bpm, 3)
+        else:
+            position, _beats = BEATGRID_MARKER.unpack_from(payload, pos)
+        markers.beatgrid.append(position)
+        pos += 8
+
+
+def decode_overview(payload, markers):
+    '''
+    Keep the Overview tag payload's waveform blocks as is
+    '''
+    markers.overview = bytes(payload[2:])
+
+
+DECODERS = {
+    'markers2': decode_markers2,
+    'beatgrid': decode_beatgrid,
+    'overview': decode_overview,
+}
+
+
+def _syncsafe(b):
+    return (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+
+
+def id3_payloads(tag):
+    '''
+    Yield (kind, payload) for each Serato GEOB frame in an ID3v2.3/2.4 tag (bytes, including header)
+    '''
+    if tag[:3] != b'ID3' or tag[3] not in (3, 4):
+        return
+    major, flags = tag[3], tag[5]
+    end = 10 + _syncsafe(tag[6:10])
+    if len(tag) < end:
+        raise ValueError('Truncated ID3 tag')
+    pos = 10
+    if flags & 0x40:
+        # Skip extended header
+        pos += _syncsafe(tag[10:14]) if major == 4 else 4 + int.from_bytes(tag[10:14], byteorder='big')
+    while pos + 10 <= end:
+        frame_id = tag[pos:pos + 4]
+        if frame_id[:1] == b'\x00':
+            # Padding
+            break
+        size = _syncsafe(tag[pos + 4:pos + 8]) if major == 4 else int.from_bytes(tag[pos + 4:pos + 8], byteorder='big')
+        if pos + 10 + size > end:
+            raise ValueError(f'ID3 frame {frame_id!r} overruns the tag')
+        body = tag[pos + 10:pos + 10 + size]
+        pos += 10 + size
+        if frame_id != b'GEOB' or not body:
+            continue
+        encoding = ID3_ENCODINGS.get(body[0], 'latin-1')
+        _mime, bpos = _cstring(body, 1)
+        _filename, bpos = _cstring(body, bpos, encoding)
+        desc, bpos = _cstring(body, bpos, encoding)
+        kind = GEOB_DESCRIPTIONS.get(desc)
+        if kind:
+            yield kind, body[bpos:]
+
+
+def read_id3(fp):
+    '''
+    Read an ID3v2 tag from the current position of fp, returning its bytes, or None
+    '''
+    head = fp.read(10)
+    if len(head) < 10 or head[:3] != b'ID3':
+        return None
+    return head + fp.read(_syncsafe(head[6:10]))
+
+
+def iff_chunk(fp, wanted, big_endian):
+    '''
+    Find a chunk in a RIFF/AIFF file & return its body, or None. fp must be just past the form header
+    '''
+    order = 'big' if big_endian else 'little'
+    while True:
+        head = fp.read(8)
+        if len(head) < 8:
+            return None
+        size = int.from_bytes(head[4:], byteorder=order)
+        if head[:4] in wanted:
+            return fp.read(size)
+        fp.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def flac_payloads(fp):
+    '''
+    Yield (kind, payload) for each Serato Vorbis comment in a FLAC file. fp must be just past 'fLaC'
+    '''
+    last = False
+    while not last:
+        head = fp.read(4)
+        if len(head) < 4:
+            raise ValueError('FLAC metadata ends before its last block')
+        last, block_type = head[0] & 0x80, head[0] & 0x7f
+        size = int.from_bytes(head[1:], byteorder='big')
+        if block_type != 4:
+            fp.seek(size, os.SEEK_CUR)
+            continue
+        block = fp.read(size)
+        if len(block) < size:
+            raise ValueError('Truncated FLAC Vorbis comment block')
+        pos = 4 + int.from_bytes(block[:4], byteorder='little')
+        count = int.from_bytes(block[pos:pos + 4], byteorder='little')
+        pos += 4
+        for _ in range(count):
+            clen = int.from_bytes(block[pos:pos + 4], byteorder='little')
+            if pos + 4 + clen > size:
+                raise ValueError('FLAC Vorbis comment overruns its block')
+            comment = block[pos + 4:pos + 4 + clen]
+            pos += 4 + clen
+            key, _, value = comment.partition(b'=')
+            kind = VORBIS_KEYS.get(key.decode('ascii', 'replace').upper())
+            if kind:
+                # Newline-wrapped & sometimes unpadded, so pad after unwrapping, as for Markers2
+                b64 = value.replace(b'\n', b'')
+                try:
+                    data = base64.b64decode(b64 + b'=' * (-len(b64) % 4))
+                except binascii.Error:
+                    # Damaged tag, rather than a damaged file; skip it as for a bad GEOB frame
+                    continue
+                # Same header as the ID3 GEOB frame: mime type, then empty filename, then description
+                _mime, dpos = _cstring(data, 0)
+                _desc, dpos = _cstring(data, dpos + 1)
+                yield kind, data[dpos:]
+        return
+
+
+def tag_payloads(path):
+    '''
+    Yield (kind, payload) for each Serato tag in the audio file at path
+
+    Raises:
+        ValueError: if the file isn't a container whose tags can be read (MP3, FLAC,
+            AIFF or WAV), or its tag structure is damaged
+    '''
+    with open(path, 'rb') as fp:
+        magic = fp.read(12)
+        if magic[:3] == b'ID3':
+            fp.seek(0)
+            yield from id3_payloads(read_id3(fp) or b'')
+        elif magic[:4] == b'fLaC':
+            fp.seek(4)
+            yield from flac_payloads(fp)
+        elif magic[:4] == b'FORM' and magic[8:12] in (b'AIFF', b'AIFC'):
+            yield from id3_payloads(iff_chunk(fp, (b'ID3 ', b'id3 '), True) or b'')
+        elif magic[:4] == b'RIFF' and magic[8:12] == b'WAVE':
+            yield from id3_payloads(iff_chunk(fp, (b'id3 ', b'ID3 '), False) or b'')
+        elif magic[:1] == b'\xff' and magic[1:2] >= b'\xe0':
+            # MPEG frame sync: an MP3 with no ID3 tag, so no Serato tags
+            return
+        else:
+            raise ValueError(f'Unsupported audio container: {path}')
+
+
+def extract(path):
+    '''
+    Read & decode the Serato tags of one audio file. Return serato_markers,
+    or None if the file can't be read, isn't a supported container (e.g. MP4),
+    or its tag container (ID3/IFF/FLAC structure) is damaged, so that such files
+    aren't mistaken for ones with no cues
+
+    Damaged tags within an otherwise sound file are skipped
+    '''
+    markers = serato_markers()
+    try:
+        for kind, payload in tag_payloads(path):
+            try:
+                DECODERS[kind](payload, markers)
+            except (struct.error, ValueError, IndexError):
+                # Damaged tag; keep whatever else can be read
+                pass
+    except (OSError, struct.error, ValueError, IndexError):
+        return None
+    return markers
+
+
+class marker_cache(stat_cache):
+    '''
+    serato_markers keyed by file path, valid while the file's (mtime, size) is unchanged
+
+    path - file where the cache is pickled. If None, the cache is in memory only
+    '''
+
+
+def extract_all(paths, root='/', cache=None, workers=None, batch_size=64):
+    '''
+    Extract Serato tag data for many files on a process pool. Return dict of path to
+    serato_markers (None for files that are missing, unreadable or unsupported)
+
+    cache - optional marker_cache. Other arguments as for onya.etc.statcache.process_files
+    '''
+    cache = cache if cache is not None else marker_cache()
+    return process_files(extract, paths, cache, root=root, workers=workers, batch_size=batch_size)
+
+
+class marker_index:
+    '''
+    Library-wide index over extraction results, for queries without re-reading files
+
+    markers - dict of track path to serato_markers (or None), as from extract_all
+
+    unreadable - paths with no markers (None), e.g. missing, damaged or MP4 files.
+        These aren't included in the other sets
+    '''
+    def __init__(self, markers):
+        self.markers = markers
+        self.unreadable = set()
+        self.no_cues = set()
+        self.no_beatgrid = set()
+        self.beatgrid_locked = set()
+        self.has_loops = set()
+        for path, m in markers.items():
+            if m is None:
+                self.unreadable.add(path)
+                continue
+            if not m.cue_positions:
+                self.no_cues.add(path)
+            if not m.beatgrid:
+                self.no_beatgrid.add(path)
+            if m.bpm_locked:
+                self.beatgrid_locked.add(path)
+            if m.loops:
+                self.has_loops.add(path)
+
+    def where(self, pred):
+        '''
+        Return paths whose serato_markers satisfy pred, e.g. lambda m: len(m.cue_positions) < 3
+        '''
+        return { path for (path, m) in self.markers.items() if m is not None and pred(m) }
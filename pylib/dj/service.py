@@ -0,0 +1,224 @@
+# onya.dj.service
+'''
+Local asyncio HTTP/JSON query service over an in-memory Serato library
+
+The library is parsed once at startup & kept warm, so clients get answers
+without paying the parse cost. Endpoints (all responses are JSON):
+
+GET  /search?q=SWV&limit=50       Fuzzy search on artist, song, album & comment
+GET  /query?tgen=House&tbpm=120..128&limit=50
+                                  Field match; lo..hi for inclusive ranges (either end optional)
+GET  /crates                      Names of all crates
+GET  /crate?name=House%25%25Deep  Tracks in a crate
+GET  /track?path=Music/x.mp3      A track, plus the crates it's in
+POST /reload                      Re-parse the DB & crates, then swap them in. Crates
+                                  which can't be parsed are skipped & listed
+
+List results are streamed using chunked transfer encoding.
+
+>>> from onya.dj.service import serve
+>>> serve('/sdb/database V2', port=8237)
+'''
+
+import sys
+import json
+import asyncio
+from urllib.parse import urlsplit, parse_qs
+
+from onya.dj.library import library, request_error
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8237
+# Number of list items JSON encoded & written between drains of a streamed response
+STREAM_BATCH = 500
+
+# Endpoint (library.answer op) -> query string parameters passed on
+ENDPOINT_PARAMS = {'search': ('q',), 'query': (), 'crates': (), 'crate': ('name',), 'track': ('path',)}
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def query_value(text):
+    '''
+    Interpret a query string value as int, float or string, in that order of preference
+    '''
+    for conv in (int, float):
+        try:
+            return conv(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_criteria(params):
+    '''
+    Convert query string params (as from parse_qs) to library.query criteria.
+    Values of the form lo..hi become ranges
+    '''
+    criteria = {}
+    for field, vals in params.items():
+        val = vals[-1]
+        if '..' in val:
+            lo, hi = val.split('..', 1)
+            criteria[field] = (query_value(lo) if lo else None, query_value(hi) if hi else None)
+        else:
+            criteria[field] = query_value(val)
+    return criteria
+
+
+class service:
+    '''
+    Holds the current library & answers requests against it
+
+    A reload builds a complete new library off the event loop, then swaps it in,
+    so requests in flight keep working with the library they started on
+    '''
+    def __init__(self, dbpath, cratedir=None, workers=None):
+        self.dbpath, self.cratedir, self.workers = dbpath, cratedir, workers
+        self.lib = None
+        self._reloading = None
+
+    def load(self):
+        lib = library(self.dbpath, self.cratedir, self.workers)
+        lib.load()
+        self.lib = lib
+
+    async def reload(self):
+        # Coalesce concurrent reload requests into one
+        if not self._reloading:
+            loop = asyncio.get_running_loop()
+            self._reloading = loop.run_in_executor(None, self.load)
+        try:
+            await self._reloading
+        finally:
+            self._reloading = None
+        return {'tracks': len(self.lib.tracks), 'crates': len(self.lib.crates),
+                'crate_errors': self.lib.crate_errors}
+
+    async def dispatch(self, method, target):
+        '''
+        Route a request. Return (status, result, streamed)
+        '''
+        url = urlsplit(target)
+        params = parse_qs(url.query)
+        try:
+            limit = int(params.pop('limit', ['0'])[-1])
+        except ValueError:
+            raise request_error(400, 'limit must be a whole number')
+
+        if url.path == '/reload':
+            if method != 'POST':
+                raise request_error(405, 'Use POST to reload')
+            return 200, await self.reload(), False
+        if method != 'GET':
+            raise request_error(405, f'{method} not supported for {url.path}')
+
+        op = url.path.lstrip('/')
+        if op not in ENDPOINT_PARAMS:
+            raise request_error(404, f'Unknown endpoint: {url.path}')
+        if op == 'query':
+            args = {'criteria': parse_criteria(params)}
+        else:
+            args = { name: params[name][-1] for name in ENDPOINT_PARAMS[op] if name in params }
+        lib = self.lib
+        if op in ('search', 'query'):
+            # Fuzzy matching & range scans are CPU bound, so keep them off the event loop
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(None, lib.answer, op, args, limit)
+        else:
+            result = lib.answer(op, args, limit)
+        return 200, result, isinstance(result, list)
+
+    async def handle_client(self, reader, writer):
+        '''
+        Serve HTTP/1.1 requests on one connection, honoring keep-alive
+        '''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, 400, {'error': 'Malformed request line'}, False, False)
+                    break
+                headers = {}
+                while True:
+                    hline = await reader.readline()
+                    if hline in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = hline.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                # Bodies aren't used by any endpoint, but must be consumed to keep the connection in sync
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    # No telling where the next request starts, so give up on the connection
+                    await self.respond(writer, 400, {'error': 'Malformed Content-Length'}, False, False)
+                    break
+                if length:
+                    await reader.readexactly(length)
+                keep_alive = (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close')
+
+                try:
+                    status, result, streamed = await self.dispatch(method, target)
+                except request_error as e:
+                    status, result, streamed = e.status, {'error': str(e)}, False
+                except ValueError as e:
+                    status, result, streamed = 400, {'error': str(e)}, False
+                except Exception as e:
+                    status, result, streamed = 500, {'error': repr(e)}, False
+                await self.respond(writer, status, result, streamed, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, result, streamed, keep_alive):
+        head = [f'HTTP/1.1 {status} {REASONS.get(status, "")}',
+                'Content-Type: application/json; charset=utf-8',
+                'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+        if not streamed:
+            body = json.dumps(result).encode('utf-8')
+            head.append(f'Content-Length: {len(body)}')
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+            return
+
+        head.append('Transfer-Encoding: chunked')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+        def chunk(text):
+            data = text.encode('utf-8')
+            writer.write(f'{len(data):x}\r\n'.encode('latin-1') + data + b'\r\n')
+
+        chunk('[')
+        for start in range(0, len(result), STREAM_BATCH):
+            batch = ','.join(json.dumps(item) for item in result[start:start + STREAM_BATCH])
+            chunk(batch if start == 0 else ',' + batch)
+            await writer.drain()
+        chunk(']')
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+async def run(svc, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    server = await asyncio.start_server(svc.handle_client, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def serve(dbpath, cratedir=None, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None):
+    '''
+    Load the library, then answer requests until interrupted
+    '''
+    svc = service(dbpath, cratedir, workers)
+    svc.load()
+    for path, err in svc.lib.crate_errors.items():
+        print(f'Skipped unreadable crate {path}: {err}', file=sys.stderr)
+    asyncio.run(run(svc, host, port))
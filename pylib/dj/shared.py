@@ -0,0 +1,362 @@
+# onya.dj.shared
+'''
+Library snapshots in shared memory, so several processes (notebook kernels,
+workers) can use one parse of the DB
+
+One process parses the DB & publishes its tracks as a columnar snapshot: per
+field, an array of numbers, or of codes into a table of distinct strings, plus
+an index of rows sorted by file path. Other processes attach read-only, with no
+copying. A small manifest segment names the current version, so after the
+publisher reloads, readers can switch over with refresh().
+
+>>> # Publisher
+>>> from onya.dj.serial.serato import db
+>>> from onya.dj.shared import publisher
+>>> sdb = db()
+>>> sdb.load('/sdb/database V2')
+>>> pub = publisher('onya-dj')
+>>> pub.publish(sdb.tracks)
+
+>>> # Any other process
+>>> from onya.dj.shared import attach
+>>> snap = attach('onya-dj')
+>>> snap.track('Music/FLAC/8mm/Opener.flac')
+>>> snap = snap.refresh()    # Switch to the latest version, if there's a newer one
+'''
+
+import json
+import time
+import struct
+import weakref
+from array import array
+from bisect import bisect_left
+from multiprocessing import shared_memory
+
+MANIFEST_SIZE = 1 << 16
+MANIFEST_HEAD = struct.Struct('<QI')
+ALIGN = 8
+
+MISSING_INT = -2 ** 63
+MISSING_BOOL = -1
+MISSING_CODE = -1
+
+# Column kind -> array typecode
+TYPECODES = {'bool': 'b', 'int': 'q', 'float': 'd', 'str': 'i'}
+
+# Segments created by publishers in this process, which stay tracked
+_created = set()
+
+
+def _shared_memory(name, **kwargs):
+    '''
+    Attach to an existing segment without registering it with this process's
+    resource tracker, which would otherwise destroy it when this process exits
+    '''
+    try:
+        return shared_memory.SharedMemory(name, track=False, **kwargs)
+    except TypeError:
+        # Before Python 3.13 there's no track option
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name, **kwargs)
+        if name not in _created:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _create(name, size):
+    shm = shared_memory.SharedMemory(name, create=True, size=size)
+    _created.add(name)
+    return shm
+
+
+def _destroy(shm, name):
+    shm.close()
+    shm.unlink()
+    _created.discard(name)
+
+
+def _release(views, shm):
+    '''
+    Release memoryviews into a segment, then unmap it. The mapping can't be closed while views remain
+    '''
+    while views:
+        views.pop().release()
+    shm.close()
+
+
+def _kind(values):
+    kinds = set()
+    for v in values:
+        if v is None:
+            continue
+        kinds.add('bool' if isinstance(v, bool) else 'int' if isinstance(v, int)
+                  else 'float' if isinstance(v, float) else 'str')
+    if kinds <= {'bool'}:
+        return 'bool'
+    if kinds <= {'int'}:
+        return 'int'
+    if kinds <= {'int', 'float'}:
+        return 'float'
+    return 'str'
+
+
+def columns(tracks):
+    '''
+    Convert a list of track dicts to columns. Return dict of field -> (kind, list of
+    arrays making up the column)
+    '''
+    fields = {}
+    for t in tracks:
+        for k in t:
+            fields.setdefault(k, None)
+    cols = {}
+    for field in fields:
+        values = [ t.get(field) for t in tracks ]
+        kind = _kind(values)
+        if kind == 'bool':
+            cols[field] = (kind, [array('b', (MISSING_BOOL if v is None else int(v) for v in values))])
+        elif kind == 'int':
+            cols[field] = (kind, [array('q', (MISSING_INT if v is None else v for v in values))])
+        elif kind == 'float':
+            cols[field] = (kind, [array('d', (float('nan') if v is None else v for v in values))])
+        else:
+            table, codes = {}, array('i')
+            for v in values:
+                codes.append(MISSING_CODE if v is None else table.setdefault(str(v), len(table)))
+            blob = bytearray()
+            offsets = array('Q', [0])
+            for s in table:
+                blob += s.encode('utf-8')
+                offsets.append(len(blob))
+            cols[field] = (kind, [codes, offsets, array('B', blob)])
+    return cols
+
+
+class publisher:
+    '''
+    Publishes versions of a library snapshot under a name
+
+    The manifest & current data segments live until close() (or process exit),
+    so keep the publisher process running while others use the snapshot
+    '''
+    def __init__(self, name='onya-dj'):
+        self.name = name
+        self.version = 0
+        self.data = self.segment = None
+        try:
+            self.manifest = _create(name, MANIFEST_SIZE)
+        except FileExistsError:
+            # Left over from an earlier publisher; take it over
+            self.manifest = shared_memory.SharedMemory(name)
+            _created.add(name)
+            gen, length = MANIFEST_HEAD.unpack_from(self.manifest.buf)
+            if length:
+                self.version = json.loads(bytes(self.manifest.buf[MANIFEST_HEAD.size:MANIFEST_HEAD.size + length]))['version']
+
+    def publish(self, tracks):
+        '''
+        Publish a new version of the snapshot from a list of track dicts. Return the version number
+        '''
+        cols = columns(tracks)
+        directory = {}
+        pos = 0
+        for field, (kind, arrays) in cols.items():
+            parts = []
+            for a in arrays:
+                parts.append((pos, len(a)))
+                pos += -(-len(a) * a.itemsize // ALIGN) * ALIGN
+            directory[field] = {'kind': kind, 'parts': parts}
+        order = array('i', sorted(range(len(tracks)), key=lambda ix: tracks[ix].get('pfil') or ''))
+        directory_index = (pos, len(order))
+        pos += -(-len(order) * order.itemsize // ALIGN) * ALIGN
+
+        version = self.version + 1
+        segment = f'{self.name}.v{version}'
+        data = _create(segment, max(pos, 1))
+        for field, (kind, arrays) in cols.items():
+            for a, (offset, _) in zip(arrays, directory[field]['parts']):
+                raw = a.tobytes()
+                data.buf[offset:offset + len(raw)] = raw
+        raw = order.tobytes()
+        data.buf[directory_index[0]:directory_index[0] + len(raw)] = raw
+
+        manifest = json.dumps({'version': version, 'segment': segment, 'rows': len(tracks),
+                               'columns': directory, 'path_index': directory_index}).encode('utf-8')
+        if MANIFEST_HEAD.size + len(manifest) > MANIFEST_SIZE:
+            _destroy(data, segment)
+            raise ValueError(f'Snapshot directory too large ({len(manifest)} bytes)')
+        self._write_manifest(manifest)
+
+        # Readers of the old version keep their mapping; only the name goes away
+        if self.data is not None:
+            _destroy(self.data, self.segment)
+        self.data, self.segment, self.version = data, segment, version
+        return version
+
+    def _write_manifest(self, manifest):
+        # Seqlock: the generation is odd while the manifest is being rewritten
+        buf = self.manifest.buf
+        gen, _ = MANIFEST_HEAD.unpack_from(buf)
+        gen += gen & 1
+        MANIFEST_HEAD.pack_into(buf, 0, gen + 1, 0)
+        buf[MANIFEST_HEAD.size:MANIFEST_HEAD.size + len(manifest)] = manifest
+        MANIFEST_HEAD.pack_into(buf, 0, gen + 2, len(manifest))
+
+    def close(self):
+        '''
+        Withdraw the snapshot. Processes already attached keep their mappings
+        '''
+        if self.data is not None:
+            _destroy(self.data, self.segment)
+        if self.manifest is not None:
+            _destroy(self.manifest, self.name)
+        self.data = self.segment = self.manifest = None
+
+
+def read_manifest(manifest, timeout=1.0):
+    '''
+    Consistently read the manifest JSON from an attached manifest segment
+    '''
+    buf = manifest.buf
+    deadline = time.monotonic() + timeout
+    while True:
+        gen, length = MANIFEST_HEAD.unpack_from(buf)
+        if not gen & 1:
+            body = bytes(buf[MANIFEST_HEAD.size:MANIFEST_HEAD.size + length])
+            if MANIFEST_HEAD.unpack_from(buf)[0] == gen:
+                if not length:
+                    raise LookupError('Nothing published yet')
+                return json.loads(body)
+        if time.monotonic() > deadline:
+            raise TimeoutError('Snapshot manifest is not settling')
+        time.sleep(0.001)
+
+
+class snapshot:
+    '''
+    Read-only, zero-copy view of one published version of a library snapshot
+    '''
+    def __init__(self, name, manifest_shm, info):
+        self.name = name
+        self._manifest = manifest_shm
+        self.version = info['version']
+        self.rows = info['rows']
+        data = _shared_memory(info['segment'])
+        buf = data.buf.toreadonly()
+        # Every view into the segment, so they can be released before it's unmapped
+        self._views = [buf]
+        self._columns = {}
+        for field, col in info['columns'].items():
+            kind = col['kind']
+            views = []
+            for (offset, length), code in zip(col['parts'], (TYPECODES[kind], 'Q', 'B')):
+                size = struct.calcsize(code)
+                views.append(buf[offset:offset + length * size].cast(code))
+            self._views.extend(views)
+            self._columns[field] = (kind, views)
+        offset, length = info['path_index']
+        self._path_order = buf[offset:offset + length * 4].cast('i')
+        self._views.append(self._path_order)
+        self._pfil = self._columns.get('pfil')
+        self._finalizer = weakref.finalize(self, _release, self._views, data)
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def fields(self):
+        return list(self._columns)
+
+    def column(self, field):
+        '''
+        Return the raw column for a field: a read-only memoryview of numbers (with
+        MISSING_INT, MISSING_BOOL or NaN where missing) or, for strings, of codes
+        (MISSING_CODE where missing) to be looked up with string()
+        '''
+        return self._columns[field][1][0]
+
+    def string(self, field, code):
+        '''
+        Return the string with the given code in a string column's table
+        '''
+        _, (_, offsets, blob) = self._columns[field]
+        return bytes(blob[offsets[code]:offsets[code + 1]]).decode('utf-8')
+
+    def value(self, field, row):
+        kind, views = self._columns[field]
+        v = views[0][row]
+        if kind == 'str':
+            return None if v == MISSING_CODE else self.string(field, v)
+        if kind == 'bool':
+            return None if v == MISSING_BOOL else bool(v)
+        if kind == 'int':
+            return None if v == MISSING_INT else v
+        return None if v != v else v
+
+    def __getitem__(self, row):
+        '''
+        Return the track at a row number as a dict
+        '''
+        if not 0 <= row < self.rows:
+            raise IndexError(row)
+        t = {}
+        for field in self._columns:
+            v = self.value(field, row)
+            if v is not None:
+                t[field] = v
+        return t
+
+    def __iter__(self):
+        for row in range(self.rows):
+            yield self[row]
+
+    def track(self, path):
+        '''
+        Return the track with the given file path (pfil), or None, by binary search of the path index
+        '''
+        if self._pfil is None:
+            return None
+        order = self._path_order
+        keys = _path_keys(self, order)
+        ix = bisect_left(keys, path)
+        if ix < len(order) and keys[ix] == path:
+            return self[order[ix]]
+        return None
+
+    def refresh(self):
+        '''
+        Return a snapshot of the latest published version: self if it's still current
+        '''
+        info = read_manifest(self._manifest)
+        if info['version'] == self.version:
+            return self
+        return snapshot(self.name, self._manifest, info)
+
+    def close(self):
+        '''
+        Unmap this version. Also happens when the snapshot is garbage collected
+        '''
+        self._columns = self._path_order = self._pfil = None
+        self._finalizer()
+
+
+class _path_keys:
+    '''
+    Sequence of file paths in path index order, decoded on demand, for bisect
+    '''
+    def __init__(self, snap, order):
+        self.snap, self.order = snap, order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, ix):
+        return self.snap.value('pfil', self.order[ix]) or ''
+
+
+def attach(name='onya-dj'):
+    '''
+    Attach read-only to the latest version of a published snapshot
+    '''
+    manifest = _shared_memory(name)
+    return snapshot(name, manifest, read_manifest(manifest))
@@ -0,0 +1,233 @@
+# onya.dj.similar
+'''
+"More like this": nearest neighbors over track metadata, vectorized with NumPy
+
+Each track becomes a row of a feature matrix combining BPM, key, year, genre,
+label & duration. Numeric fields are standardized; key is placed on the Camelot
+wheel so harmonically compatible keys sit close together; genre & label are
+hashed one-hot. Distances are computed in blocks, so memory stays bounded on
+large libraries, & an optional inverted-file index (coarse k-means clusters)
+trades a little recall for speed.
+
+>>> from onya.dj.serial.serato import db
+>>> sdb = db()
+>>> sdb.load('/sdb/database V2')
+>>> for t in sdb.similar(sdb.tracks[0], k=10):
+...     print(t)
+'''
+
+import re
+import zlib
+
+# Relative weight of each kind of feature in the distance
+WEIGHTS = {'bpm': 2.0, 'key': 1.5, 'year': 1.0, 'genre': 1.5, 'label': 0.75, 'duration': 0.5}
+GENRE_BUCKETS = 32
+LABEL_BUCKETS = 64
+# Rows of the feature matrix handled per distance computation block
+BLOCK_ROWS = 65536
+
+PITCHES = {'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7, 'a': 9, 'b': 11}
+KEY_PAT = re.compile(r'\s*([a-gA-G])\s*([#b♯♭]?)\s*(m|min|minor|maj|major)?\s*$')
+CAMELOT_PAT = re.compile(r'\s*(\d{1,2})\s*([abAB])\s*$')
+
+
+def camelot(key):
+    '''
+    Return (Camelot wheel number 1-12, is minor) for a key name such as 'F#m', 'Bb' or '8A', or None
+    '''
+    if not key:
+        return None
+    m = CAMELOT_PAT.match(key)
+    if m:
+        num = int(m.group(1))
+        return (num, m.group(2).lower() == 'a') if 1 <= num <= 12 else None
+    m = KEY_PAT.match(key)
+    if not m:
+        return None
+    note, accidental, mode = m.groups()
+    pitch = PITCHES[note.lower()] + {'#': 1, '♯': 1, 'b': -1, '♭': -1}.get(accidental, 0)
+    minor = bool(mode) and mode.startswith('m') and not mode.startswith('maj')
+    # Minor keys share a wheel number with their relative major
+    major_pitch = (pitch + 3) % 12 if minor else pitch % 12
+    return (major_pitch * 7 + 7) % 12 + 1, minor
+
+
+NUMERIC_FIELDS = (('bpm', 'tbpm'), ('year', 'ttyr'), ('duration', 'tlen'))
+
+
+def _numeric(tracks, field):
+    '''
+    Column of a numeric field as float64, with NaN where missing (or zero)
+    '''
+    import numpy as np
+    return np.array([ t.get(field) if isinstance(t.get(field), (int, float)) and t.get(field) else np.nan
+                      for t in tracks ], dtype=np.float64)
+
+
+def _bucket(text, nbuckets):
+    return zlib.crc32(text.strip().lower().encode('utf-8')) % nbuckets
+
+
+def feature_matrix(tracks):
+    '''
+    Build the (len(tracks), d) float32 feature matrix for a list of tracks. Return (matrix, stats),
+    where stats holds the normalization parameters, for computing vectors of other tracks
+    '''
+    import numpy as np
+
+    stats = {}
+    for name, field in NUMERIC_FIELDS:
+        col = _numeric(tracks, field)
+        known = col[~np.isnan(col)]
+        stats[name] = (float(known.mean()), float(known.std()) or 1.0) if len(known) else (0.0, 1.0)
+    return _features(tracks, stats), stats
+
+
+def _features(tracks, stats):
+    import numpy as np
+
+    n = len(tracks)
+    width = 3 + 3 + GENRE_BUCKETS + LABEL_BUCKETS
+    mat = np.zeros((n, width), dtype=np.float32)
+
+    # Numeric, standardized, with missing values at the mean
+    for col, (name, field) in enumerate(NUMERIC_FIELDS):
+        mean, std = stats[name]
+        vals = _numeric(tracks, field)
+        vals = np.where(np.isnan(vals), 0.0, (vals - mean) / std)
+        mat[:, col] = vals * WEIGHTS[name]
+
+    # Key on the Camelot wheel: neighbors (a fifth apart) & relative major/minor are close
+    wheel = [ camelot(t.get('tkey')) for t in tracks ]
+    for row, pos in enumerate(wheel):
+        if pos:
+            angle = 2 * np.pi * (pos[0] - 1) / 12
+            mat[row, 3:6] = (np.cos(angle), np.sin(angle), 0.5 if pos[1] else -0.5)
+    mat[:, 3:6] *= WEIGHTS['key']
+
+    # Hashed one-hot categoricals, scaled so two different values are `weight` apart
+    for offset, field, nbuckets, name in ((6, 'tgen', GENRE_BUCKETS, 'genre'),
+                                           (6 + GENRE_BUCKETS, 'tlbl', LABEL_BUCKETS, 'label')):
+        scale = WEIGHTS[name] / np.sqrt(2)
+        for row, t in enumerate(tracks):
+            if t.get(field):
+                mat[row, offset + _bucket(t[field], nbuckets)] = scale
+    return mat
+
+
+class similarity_index:
+    '''
+    Nearest neighbor search over the metadata feature matrix of a list of tracks
+
+    tracks - list of track dicts, e.g. db.tracks
+    '''
+    def __init__(self, tracks):
+        import numpy as np
+
+        self.tracks = tracks
+        self.matrix, self.stats = feature_matrix(tracks)
+        self.sqnorms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        self.rows = { t['pfil']: ix for (ix, t) in enumerate(tracks) if 'pfil' in t }
+        self.centroids = self.lists = None
+
+    def vector(self, t):
+        '''
+        Feature vector for a track, which needn't be in the index
+        '''
+        row = self.rows.get(t.get('pfil'))
+        if row is not None and self.tracks[row] is t:
+            return self.matrix[row]
+        return _features([t], self.stats)[0]
+
+    def _nearest(self, q, k, candidates=None):
+        '''
+        Return (row numbers, squared distances) of the k rows nearest to q, nearest first.
+        Only considers the given candidate rows, if any
+        '''
+        import numpy as np
+
+        qn = float(q @ q)
+        best_rows = np.empty(0, dtype=np.int64)
+        best_dist = np.empty(0, dtype=np.float32)
+        total = len(self.matrix) if candidates is None else len(candidates)
+        for start in range(0, total, BLOCK_ROWS):
+            if candidates is None:
+                rows = np.arange(start, min(start + BLOCK_ROWS, total))
+                block, norms = self.matrix[start:start + BLOCK_ROWS], self.sqnorms[start:start + BLOCK_ROWS]
+            else:
+                rows = candidates[start:start + BLOCK_ROWS]
+                block, norms = self.matrix[rows], self.sqnorms[rows]
+            dist = norms - 2 * (block @ q) + qn
+            if len(dist) > k:
+                keep = np.argpartition(dist, k)[:k]
+                rows, dist = rows[keep], dist[keep]
+            best_rows = np.concatenate((best_rows, rows))
+            best_dist = np.concatenate((best_dist, dist))
+            if len(best_dist) > k:
+                keep = np.argpartition(best_dist, k)[:k]
+                best_rows, best_dist = best_rows[keep], best_dist[keep]
+        order = np.argsort(best_dist, kind='stable')
+        return best_rows[order], np.maximum(best_dist[order], 0)
+
+    def build_approximate(self, nlist=None, iterations=8, sample=50000, seed=0):
+        '''
+        Build an inverted file index: k-means cluster the rows, so that queries
+        only scan rows in the clusters nearest the query
+
+        nlist - number of clusters (default: about the square root of the number of tracks)
+        '''
+        import numpy as np
+
+        n = len(self.matrix)
+        nlist = nlist or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        train = self.matrix[rng.choice(n, size=min(n, sample), replace=False)]
+        centroids = train[rng.choice(len(train), size=min(nlist, len(train)), replace=False)].copy()
+        for _ in range(iterations):
+            assign = self._assign(train, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            counts = np.bincount(assign, minlength=len(centroids))
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        assign = self._assign(self.matrix, centroids)
+        order = np.argsort(assign, kind='stable')
+        bounds = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+        self.centroids = centroids
+        self.lists = [ order[bounds[c]:bounds[c + 1]] for c in range(len(centroids)) ]
+
+    @staticmethod
+    def _assign(rows, centroids):
+        import numpy as np
+
+        assign = np.empty(len(rows), dtype=np.int64)
+        cnorms = np.einsum('ij,ij->i', centroids, centroids)
+        for start in range(0, len(rows), BLOCK_ROWS):
+            block = rows[start:start + BLOCK_ROWS]
+            assign[start:start + BLOCK_ROWS] = np.argmin(cnorms - 2 * (block @ centroids.T), axis=1)
+        return assign
+
+    def similar(self, t, k=10, approximate=False, nprobe=8):
+        '''
+        Return up to k (track, distance) pairs most like track t, nearest first, excluding t itself
+
+        approximate - if True, scan only the nprobe clusters nearest t, building the
+            cluster index on first use
+        '''
+        import numpy as np
+
+        if not len(self.matrix):
+            return []
+        q = self.vector(t)
+        candidates = None
+        if approximate:
+            if self.centroids is None:
+                self.build_approximate()
+            cdist = np.einsum('ij,ij->i', self.centroids, self.centroids) - 2 * (self.centroids @ q)
+            probe = np.argsort(cdist)[:nprobe]
+            candidates = np.concatenate([ self.lists[c] for c in probe ] or [np.empty(0, dtype=np.int64)])
+        # t may be a copy (e.g. decoded from JSON), so recognize it by file path too
+        path = t.get('pfil')
+        rows, dist = self._nearest(q, k + 1, candidates)
+        return [ (self.tracks[r], float(np.sqrt(d))) for (r, d) in zip(rows, dist)
+                 if self.tracks[r] is not t and (path is None or self.tracks[r].get('pfil') != path) ][:k]
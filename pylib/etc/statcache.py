@@ -0,0 +1,89 @@
+# onya.etc.statcache
+
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os.path import join
+
+
+class stat_cache:
+    '''
+    Results of processing files, keyed by file path & valid while the file's
+    (mtime, size) stamp is unchanged
+
+    path - file where the cache is pickled. If None, the cache is in memory only
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path, 'rb') as fp:
+                self.entries = pickle.load(fp)
+
+    @staticmethod
+    def stamp(path):
+        '''
+        Return the (mtime, size) stamp of the file at path. Raises OSError if it can't be read
+        '''
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def get(self, path, stamp):
+        entry = self.entries.get(path)
+        if entry and entry[0] == stamp:
+            return entry[1]
+        raise KeyError(path)
+
+    def put(self, path, stamp, result):
+        self.entries[path] = (stamp, result)
+
+    def save(self):
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as fp:
+                pickle.dump(self.entries, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+
+
+def _process_batch(func, batch):
+    return [ func(path) for path in batch ]
+
+
+def process_files(func, paths, cache, root='/', workers=None, batch_size=1):
+    '''
+    Apply func to many files on a process pool, reusing cached results. Return dict of
+    path to result (None for files that are missing, or which func returns None for)
+
+    func - picklable (i.e. module level) function taking a full file path
+    paths - file paths relative to root, e.g. as in the DB's pfil fields
+    cache - stat_cache; only files whose (mtime, size) changed are processed. Results
+        other than None are added to it
+    root - volume root the paths are relative to
+    workers - number of worker processes (default: one per core)
+    batch_size - number of files sent to a worker at a time. Raise it when each file is quick
+    '''
+    results = {}
+    todo = []
+    for p in paths:
+        full = join(root, p.lstrip('/'))
+        try:
+            stamp = cache.stamp(full)
+        except OSError:
+            results[p] = None
+            continue
+        try:
+            results[p] = cache.get(p, stamp)
+        except KeyError:
+            todo.append((p, full, stamp))
+
+    batches = [ todo[i:i + batch_size] for i in range(0, len(todo), batch_size) ]
+    if batches:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            done = pool.map(partial(_process_batch, func), [ [ full for (_, full, _) in b ] for b in batches ])
+            for batch, found in zip(batches, done):
+                for (p, _, stamp), result in zip(batch, found):
+                    results[p] = result
+                    if result is not None:
+                        cache.put(p, stamp, result)
+    return results
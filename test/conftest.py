@@ -0,0 +1,52 @@
+'''
+Helpers to generate small Serato files for tests
+'''
+
+import pytest
+
+
+def field(tag, data):
+    return tag + len(data).to_bytes(4, byteorder='big') + data
+
+
+def utf16(s):
+    return s.encode('utf-16-be')
+
+
+def otrk(i, extra=b''):
+    '''
+    Raw otrk section for a made-up track number i
+    '''
+    body = (field(b'ttyp', utf16('mp3'))
+            + field(b'pfil', utf16(f'Music/a/track{i}.mp3'))
+            + field(b'tsng', utf16(f'Song {i}'))
+            + field(b'tart', utf16(f'Artist {i % 50}'))
+            + field(b'talb', utf16(f'Album {i % 20}'))
+            + field(b'tgen', utf16(['House', 'Techno', 'Hip Hop'][i % 3]))
+            + field(b'tlen', utf16('03:%02d.50' % (i % 60)))
+            + field(b'tsiz', utf16('8.2MB'))
+            + field(b'tbit', utf16('320.0kbps'))
+            + field(b'tsmp', utf16('44.1k'))
+            + (field(b'tbpm', utf16('%.2f' % (90 + i % 60))) if i % 7 else b'')
+            + field(b'tkey', utf16(['Am', 'C', 'F#m', 'Gb'][i % 4]))
+            + field(b'uadd', (1600000000 + i).to_bytes(4, byteorder='big'))
+            + field(b'bmis', b'\x00')
+            + extra)
+    return field(b'otrk', body)
+
+
+def db_header():
+    version = utf16('2.0/Serato Scratch LIVE Database')
+    return b'vrsn' + len(version).to_bytes(4, byteorder='big') + version
+
+
+@pytest.fixture
+def make_db(tmp_path):
+    '''
+    Factory writing a Serato DB file with the given number of tracks. Returns its path
+    '''
+    def _make_db(ntracks, name='database V2'):
+        path = tmp_path / name
+        path.write_bytes(db_header() + b''.join(otrk(i) for i in range(ntracks)))
+        return str(path)
+    return _make_db
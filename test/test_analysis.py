@@ -0,0 +1,104 @@
+'''
+Tests for audio analysis
+
+pytest test/test_analysis.py
+'''
+
+import wave
+import struct
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from onya.dj.analysis import (analyze_all, estimate_tempo, loudness, open_audio, read_audio,
+                              stream_loudness)
+
+
+def write_wav(path, samples, rate=22050, channels=2):
+    pcm = np.repeat((samples * 32767).astype('<i2')[:, None], channels, axis=1)
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm.tobytes())
+
+
+def clicks(bpm, secs=30, rate=22050):
+    '''
+    Decaying 80 Hz kick on every beat, with softer noise bursts off the beat, over a noise floor
+    '''
+    rng = np.random.default_rng(0)
+    samples = rng.normal(0, 0.01, int(secs * rate))
+    period = 60 / bpm
+    kick = 0.5 * np.sin(2 * np.pi * 80 * np.arange(2000) / rate) * np.exp(-np.arange(2000) / 300)
+    for beat in range(int(secs / period)):
+        start = int(beat * period * rate)
+        samples[start:start + len(kick)] += kick[:len(samples) - start]
+        off = int((beat + 0.5) * period * rate)
+        samples[off:off + 300] += 0.15 * rng.normal(0, 1, len(samples[off:off + 300]))
+    return np.clip(samples, -1, 1).astype(np.float32)
+
+
+def aiff_comm(frames, channels=1, bits=16, rate=22050):
+    '''
+    COMM chunk body, with the sample rate as an 80-bit float
+    '''
+    exponent = int(np.floor(np.log2(rate))) if rate else -16383
+    mantissa = int(rate * 2 ** (63 - exponent)) if rate else 0
+    return struct.pack('>hIhH', channels, frames, bits, exponent + 16383) + mantissa.to_bytes(8, byteorder='big')
+
+
+def write_aiff(path, samples, comm=None):
+    '''
+    Write 16-bit mono AIFF. comm replaces the COMM chunk body, e.g. to damage it
+    '''
+    comm = aiff_comm(len(samples)) if comm is None else comm
+    ssnd = struct.pack('>II', 0, 0) + (samples * 32767).astype('>i2').tobytes()
+    body = (b'AIFF' + b'COMM' + struct.pack('>I', len(comm)) + comm + b'\x00' * (len(comm) & 1)
+            + b'SSND' + struct.pack('>I', len(ssnd)) + ssnd)
+    path.write_bytes(b'FORM' + struct.pack('>I', len(body)) + body)
+
+
+@pytest.mark.parametrize('bpm', [90, 100, 118, 124, 128, 140, 160, 174])
+def test_estimate_tempo(bpm):
+    assert estimate_tempo(clicks(bpm), 22050) == pytest.approx(bpm, abs=0.5)
+
+
+def test_damaged_aiff_doesnt_abort_batch(tmp_path):
+    samples = clicks(120, secs=12)
+    write_aiff(tmp_path / 'good.aiff', samples)
+    write_aiff(tmp_path / 'short_comm.aiff', samples, comm=aiff_comm(len(samples))[:6])
+    write_aiff(tmp_path / 'cut_rate.aiff', samples, comm=aiff_comm(len(samples))[:12])
+    write_aiff(tmp_path / 'no_rate.aiff', samples, comm=aiff_comm(len(samples), rate=0))
+    write_aiff(tmp_path / 'no_channels.aiff', samples, comm=aiff_comm(len(samples), channels=0))
+    write_aiff(tmp_path / 'no_bits.aiff', samples, comm=aiff_comm(len(samples), bits=0))
+    names = ['good.aiff', 'short_comm.aiff', 'cut_rate.aiff', 'no_rate.aiff', 'no_channels.aiff',
+             'no_bits.aiff', 'missing.aiff']
+    results = analyze_all(names, root=str(tmp_path), workers=1)
+    assert results['good.aiff']['bpm'] == pytest.approx(120, abs=0.5)
+    assert [ results[name] for name in names[1:] ] == [None] * 6
+
+
+def test_stream_loudness_matches_whole():
+    rng = np.random.default_rng(0)
+    samples = (rng.normal(0, 0.1, 22050 * 7) * np.linspace(0.01, 1, 22050 * 7)).astype(np.float32)
+    whole = loudness(samples, 22050)
+    # Block boundaries that don't line up with the 100 ms steps
+    blocks = [ samples[i:i + 3001] for i in range(0, len(samples), 3001) ]
+    assert stream_loudness(blocks, 22050) == whole
+    assert whole[0] is not None
+    assert loudness(np.zeros(1000, dtype=np.float32), 22050) == (None, None)
+
+
+def test_wav_source_reads_a_window(tmp_path):
+    samples = np.linspace(-0.5, 0.5, 10000).astype(np.float32)
+    write_wav(tmp_path / 'ramp.wav', samples)
+    with open_audio(str(tmp_path / 'ramp.wav')) as src:
+        assert (src.rate, src.frames) == (22050, 10000)
+        window = src.read(4000, 100)
+        assert len(window) == 100
+        assert window[0] == pytest.approx(samples[4000], abs=1e-4)
+        assert sum(len(b) for b in src.blocks(4096)) == 10000
+    whole, rate = read_audio(str(tmp_path / 'ramp.wav'))
+    assert len(whole) == 10000 and rate == 22050
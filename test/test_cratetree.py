@@ -0,0 +1,79 @@
+'''
+Tests for the crate hierarchy & its incrementally maintained stats
+
+pytest test/test_cratetree.py
+'''
+
+import random
+
+import pytest
+
+from onya.dj.serial.serato import crate
+from onya.dj.cratetree import crate_tree
+
+TRACKS = { f'Music/t{i}.mp3': {'pfil': f'Music/t{i}.mp3', 'tlen': 180.5 + i, 'tbpm': 118 + i % 9,
+                               'tkey': ['Am', 'C', 'Gb'][i % 3]} for i in range(60) }
+
+
+def make_crate(name, paths):
+    cr = crate()
+    cr.name, cr.tracks = name, list(paths)
+    return cr
+
+
+def summary(tree):
+    '''
+    Node name -> (count, duration, bpm histogram, keys histogram) of total stats
+    '''
+    return { name: (n.total.count, pytest.approx(n.total.duration), dict(n.total.bpm), dict(n.total.keys))
+             for (name, n) in tree.nodes.items() }
+
+
+def test_updates_match_rebuild():
+    rng = random.Random(7)
+    names = ['House', 'House%%Deep', 'House%%Deep%%Late', 'Techno%%Detroit', 'Techno%%Detroit%%UR',
+             'Techno', 'Disco%%Italo%%1983']
+    paths = list(TRACKS)
+    tree = crate_tree(tracks_by_path=TRACKS)
+    current = {}
+    for _ in range(200):
+        name = rng.choice(names)
+        if name in current and rng.random() < 0.35:
+            tree.remove(name)
+            del current[name]
+        else:
+            # Includes a path not in the DB, which counts toward track totals only
+            cr = make_crate(name, rng.sample(paths, rng.randrange(0, 12)) + ['Music/missing.mp3'] * rng.randrange(2))
+            tree.update(cr)
+            current[name] = cr
+        rebuilt = crate_tree(current.values(), TRACKS)
+        assert summary(tree) == summary(rebuilt)
+        assert tree.root.total.count == sum(len(cr.tracks) for cr in current.values())
+
+
+def test_links_skip_implied_levels():
+    tree = crate_tree(tracks_by_path=TRACKS)
+    late = make_crate('House%%Deep%%Late', ['Music/t1.mp3'])
+    tree.update(late)
+    # House & House%%Deep are implied by the name, with no crates of their own
+    assert tree['House'].crate is None and late.parent is None
+
+    house = make_crate('House', ['Music/t2.mp3'])
+    tree.update(house)
+    assert late.parent is house and house.children == [late]
+    assert tree['House'].total.count == 2
+
+    deep = make_crate('House%%Deep', ['Music/t3.mp3'])
+    tree.update(deep)
+    assert late.parent is deep and deep.parent is house
+    assert house.children == [deep] and deep.children == [late]
+
+    tree.remove('House%%Deep')
+    assert late.parent is house and house.children == [late]
+    # The level stays, implied by its descendant
+    assert 'House%%Deep' in tree.nodes
+
+    tree.remove('House%%Deep%%Late')
+    assert house.children == []
+    assert set(tree.nodes) == {'House'}
+    assert tree['House'].total.count == 1
@@ -0,0 +1,63 @@
+'''
+Tests for the in-memory library & its request front ends
+
+pytest test/test_library.py
+'''
+
+import json
+
+import pytest
+
+from onya.dj.library import library, request_error
+from onya.dj.batch import respond
+
+from conftest import utf16
+
+
+def write_crate(path, track_paths):
+    version = utf16('1.0/Serato ScratchLive Crate')
+    out = b'vrsn' + len(version).to_bytes(4, byteorder='big') + version
+    for p in track_paths:
+        data = utf16(p)
+        out += b'otrk' + (len(data) + 8).to_bytes(4, byteorder='big') + b'ptrk' + len(data).to_bytes(4, byteorder='big') + data
+    path.write_bytes(out)
+
+
+@pytest.fixture
+def lib(tmp_path, make_db):
+    crates = tmp_path / 'Subcrates'
+    crates.mkdir()
+    write_crate(crates / 'House.crate', [ f'Music/a/track{i}.mp3' for i in range(0, 30, 3) ])
+    (crates / 'Broken.crate').write_bytes(b'not a crate')
+    lib = library(make_db(30))
+    lib.load()
+    return lib
+
+
+def test_bad_crate_skipped(lib):
+    assert list(lib.crates) == ['House']
+    assert [ p.endswith('Broken.crate') for p in lib.crate_errors ] == [True]
+
+
+def test_answer(lib):
+    assert lib.answer('crates', {}) == ['House']
+    assert len(lib.answer('crate', {'name': 'House'}, limit=4)) == 4
+    assert lib.answer('track', {'path': 'Music/a/track3.mp3'})['crates'] == ['House']
+    assert [ t['pfil'] for t in lib.answer('query', {'criteria': {'tbpm': [91, 92]}}) ] == \
+        ['Music/a/track1.mp3', 'Music/a/track2.mp3']
+    for op, params, status in [('crate', {'name': 'Nope'}, 404), ('track', {'path': 'x'}, 404),
+                               ('query', {'criteria': {'tbpm': [1, 'x']}}, 400),
+                               ('search', {}, 400), ('frobnicate', {}, 400)]:
+        with pytest.raises(request_error) as e:
+            lib.answer(op, params)
+        assert e.value.status == status
+    with pytest.raises(request_error):
+        lib.answer('crates', {}, limit=-1)
+
+
+def test_batch_respond(lib):
+    resp = json.loads(respond(lib, '{"id": 7, "op": "crate", "name": "House", "limit": 2}'))
+    assert resp['id'] == 7 and len(resp['result']) == 2
+    resp = json.loads(respond(lib, '{"id": "x", "op": "track", "path": "nope"}'))
+    assert resp == {'id': 'x', 'error': 'No such track: nope', 'status': 404}
+    assert json.loads(respond(lib, 'junk'))['status'] == 400
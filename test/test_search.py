@@ -0,0 +1,62 @@
+'''
+Tests for incremental as-you-type search
+
+pytest test/test_search.py
+'''
+
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('fuzzywuzzy')
+
+from fuzzywuzzy import fuzz, process
+
+from onya.dj.serial.serato import db
+from onya.dj.search import search_session
+
+from conftest import db_header, field, utf16
+
+ARTISTS = ['Abcdefghxx Crew', 'Abcdefgh Ix', 'SWV', 'Sisters With Voices', 'Swervedriver',
+           'Kerri Chandler', 'Kerri Chandlers', 'Moodymann', 'Moody Man', 'Theo Parrish']
+SONGS = ['Right Here', 'Rain', 'Weak', 'Atmosphere', 'Bar A Thym', 'Falling Up', 'Sunday Morning']
+
+
+@pytest.fixture
+def sdb(tmp_path):
+    records = []
+    for i in range(300):
+        body = (field(b'pfil', utf16(f'Music/a/track{i}.mp3'))
+                + field(b'tart', utf16(ARTISTS[i % len(ARTISTS)] + (f' {i}' if i % 4 else '')))
+                + field(b'tsng', utf16(SONGS[i % len(SONGS)]))
+                + field(b'talb', utf16(f'Album {i % 13}'))
+                + field(b'tbpm', utf16(f'{100 + i % 40}.00')))
+        records.append(field(b'otrk', body))
+    path = tmp_path / 'database V2'
+    path.write_bytes(db_header() + b''.join(records))
+    sdb = db()
+    sdb.load(str(path))
+    return sdb
+
+
+def all_matches(sdb, q):
+    return [ r[2] for r in process.extractBests(q, sdb._stdf, scorer=fuzz.partial_ratio,
+                                                score_cutoff=90, limit=None) ]
+
+
+@pytest.mark.parametrize('typed', ['abcdefghix', 'Sisters With', 'Kerri Chandlers Right', 'moody man 8'])
+def test_keystrokes_match_db_search(sdb, typed):
+    sess = search_session(sdb)
+    sdb.track_data_frame
+    for end in range(1, len(typed) + 1):
+        q = typed[:end]
+        assert [ ix for (_, ix) in sess.matches(q) ] == all_matches(sdb, q), q
+        assert list(sess.search(q).index) == list(sdb.search(q).index), q
+
+
+def test_extension_which_misses_prefix(sdb):
+    # 'abcdefghi' scores 89 against 'abcdefghxx', but 'abcdefghix' scores 90
+    sess = search_session(sdb)
+    sess.search('abcdefghi')
+    found = sess.search('abcdefghix', limit=None)
+    assert len(found)
+    assert list(found.index) == all_matches(sdb, 'abcdefghix')
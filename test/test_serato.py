@@ -0,0 +1,126 @@
+'''
+Tests for decoding Serato DB files
+
+pytest test/test_serato.py
+'''
+
+import pytest
+
+from onya.dj.serial.serato import (db, db_changes, changed_fields, decode_otrk, snapshot, OTRK_FIELD,
+                                   boolean, text_bpm, text_duration, text_sample_rate, text_size)
+
+from conftest import db_header, field, otrk, utf16
+
+
+def test_text_duration():
+    assert text_duration(utf16('03:45.12')) == pytest.approx(225.12)
+    assert text_duration(utf16('1:02:03')) == 3723
+    assert text_duration(utf16(' 00:07.5 ')) == 7.5
+    assert text_duration(utf16('about 3 minutes')) is None
+
+
+def test_text_size():
+    assert text_size(utf16('8.2MB')) == round(8.2 * 1024 ** 2)
+    assert text_size(utf16('512kb')) == 512 * 1024
+    assert text_size(utf16('1000')) == 1000
+    assert text_size(utf16('3 parsecs')) is None
+    assert text_size(utf16('')) is None
+
+
+def test_text_sample_rate():
+    assert text_sample_rate(utf16('44.1k')) == 44100
+    assert text_sample_rate(utf16('48.0k')) == 48000
+    assert text_sample_rate(utf16('96000')) == 96000
+    assert text_sample_rate(utf16('n/a')) is None
+
+
+def test_text_bpm():
+    assert text_bpm(utf16('128.00')) == 128
+    assert text_bpm(utf16('127.6')) == 128
+    assert text_bpm(utf16('')) is None
+
+
+def test_boolean():
+    assert boolean(b'\x00') is False
+    assert boolean(b'\x01') is True
+    assert boolean(b'') is None
+
+
+def test_type_prefix_fallback():
+    before = dict(OTRK_FIELD)
+    unknown = set()
+    raw = (field(b'tsng', utf16('Opener'))
+           + field(b'tzzz', utf16('new text field'))
+           + field(b'uzzz', (7).to_bytes(4, byteorder='big'))
+           + field(b'bzzz', b'\x01')
+           + field(b'xzzz', b'\x01\x02'))
+    t = decode_otrk(raw, unknown)
+    assert t == {'tsng': 'Opener', 'tzzz': 'new text field', 'uzzz': 7, 'bzzz': True}
+    assert unknown == {b'xzzz'}
+    # Fallbacks leave the dispatch table alone
+    assert OTRK_FIELD == before
+
+
+def test_load_fields(make_db):
+    sdb = db()
+    sdb.load(make_db(10))
+    assert len(sdb.tracks) == 10
+    t = sdb.tracks[1]
+    assert t['pfil'] == 'Music/a/track1.mp3'
+    assert t['tlen'] == 181.5
+    assert t['tsmp'] == 44100
+    assert t['tbpm'] == 91
+    assert t['bmis'] is False
+    assert 'tbpm' not in sdb.tracks[0]
+
+
+@pytest.mark.parametrize('ntracks', [0, 1, 5, 250])
+def test_load_parallel_parity(make_db, ntracks):
+    path = make_db(ntracks)
+    serial, parallel = db(), db()
+    serial.load(path)
+    parallel.load_parallel(path, workers=2, chunks_per_worker=3)
+    assert parallel.version == serial.version
+    assert [ dict(t) for t in parallel.tracks ] == [ dict(t) for t in serial.tracks ]
+    assert parallel.hashes == serial.hashes
+
+
+def summarize(changes):
+    return sorted((kind, (old or new)['pfil'], sorted(changed_fields(old or {}, new or {})))
+                  for (kind, old, new) in changes)
+
+
+def test_db_changes(tmp_path):
+    old_path, new_path = tmp_path / 'old', tmp_path / 'new'
+    old_path.write_bytes(db_header() + b''.join(otrk(i) for i in range(6)))
+    # Drop track 3, retag track 2 under the same path, add track 9 & reorder the rest
+    retagged = otrk(2, field(b'tcom', utf16('Retagged')))
+    new_path.write_bytes(db_header() + otrk(9) + otrk(5) + retagged + otrk(0) + otrk(1) + otrk(4))
+    changes = list(db_changes(str(old_path), str(new_path)))
+    assert summarize(changes) == [
+        ('added', 'Music/a/track9.mp3', ['bmis', 'pfil', 'talb', 'tart', 'tbit', 'tbpm', 'tgen', 'tkey',
+                                         'tlen', 'tsiz', 'tsmp', 'tsng', 'ttyp', 'uadd']),
+        ('changed', 'Music/a/track2.mp3', ['tcom']),
+        ('removed', 'Music/a/track3.mp3', ['bmis', 'pfil', 'talb', 'tart', 'tbit', 'tbpm', 'tgen', 'tkey',
+                                           'tlen', 'tsiz', 'tsmp', 'tsng', 'ttyp', 'uadd']),
+    ]
+    changed = [ (old, new) for (kind, old, new) in changes if kind == 'changed' ][0]
+    assert changed[0].get('tcom') is None and changed[1]['tcom'] == 'Retagged'
+
+    older, newer = db(), db()
+    older.load(str(old_path))
+    newer.load(str(new_path))
+    assert summarize(newer.changes_from(older)) == summarize(changes)
+    assert list(newer.changes_from(newer)) == []
+
+
+def test_snapshot_not_a_db(tmp_path):
+    empty = tmp_path / 'empty'
+    empty.write_bytes(b'')
+    junk = tmp_path / 'junk'
+    junk.write_bytes(b'not a Serato database at all')
+    for path in (empty, junk):
+        with pytest.raises(ValueError, match='Not a Serato database'):
+            snapshot(str(path))
+        with pytest.raises(ValueError, match='Not a Serato database'):
+            list(db_changes(str(path), str(junk)))
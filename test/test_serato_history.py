@@ -0,0 +1,71 @@
+'''
+Tests for reading Serato play history
+
+pytest test/test_serato_history.py
+'''
+
+import pytest
+
+from onya.dj.serial.serato_history import history_index
+
+from conftest import field
+
+
+def adat_field(number, data):
+    return field(number.to_bytes(4, byteorder='big'), data)
+
+
+def write_session(path, plays):
+    '''
+    Write a session file with one entry per (track path, start time)
+    '''
+    version = '1.0/Serato Scratch LIVE Review'.encode('utf-16-be')
+    out = b'vrsn' + len(version).to_bytes(4, byteorder='big') + version
+    out += field(b'oses', field(b'adat', adat_field(1, (1).to_bytes(4, byteorder='big'))))
+    for row, (pfil, start) in enumerate(plays):
+        out += field(b'oent', field(b'adat',
+                     adat_field(1, row.to_bytes(4, byteorder='big'))
+                     + adat_field(2, ('/' + pfil + '\x00').encode('utf-16-be'))
+                     + adat_field(28, start.to_bytes(4, byteorder='big'))
+                     + adat_field(50, b'\x01')))
+    path.write_bytes(out)
+
+
+def test_update_counts(tmp_path):
+    write_session(tmp_path / '1.session', [('Music/a.mp3', 100), ('Music/b.mp3', 300)])
+    write_session(tmp_path / '2.session', [('Music/a.mp3', 500)])
+    hist = history_index()
+    assert hist.update(tmp_path, workers=1) == 2
+    assert hist.plays('Music/a.mp3') == (2, 500)
+    assert sorted(hist.most_played(since=200)) == [('Music/a.mp3', 1), ('Music/b.mp3', 1)]
+
+
+def test_missing_sessions_dir_keeps_index(tmp_path):
+    write_session(tmp_path / '1.session', [('Music/a.mp3', 100)])
+    hist = history_index()
+    hist.update(tmp_path, workers=1)
+    with pytest.raises(FileNotFoundError):
+        hist.update(tmp_path / 'unmounted', workers=1)
+    assert hist.plays('Music/a.mp3') == (1, 100)
+
+
+def test_update_after_sessions_change(tmp_path):
+    write_session(tmp_path / '1.session', [('Music/a.mp3', 100), ('Music/b.mp3', 300)])
+    write_session(tmp_path / '2.session', [('Music/a.mp3', 500), ('Music/c.mp3', 600)])
+    write_session(tmp_path / '3.session', [('Music/b.mp3', 700)])
+    hist = history_index()
+    hist.update(tmp_path, workers=1)
+    # Session 2 rewritten without its latest plays, session 3 deleted
+    write_session(tmp_path / '2.session', [('Music/a.mp3', 400), ('Music/d.mp3', 450), ('Music/x.mp3', 460)])
+    (tmp_path / '3.session').unlink()
+    assert hist.update(tmp_path, workers=1) == 1
+    assert hist.plays('Music/a.mp3') == (2, 400)
+    assert hist.plays('Music/b.mp3') == (1, 300)
+    assert hist.plays('Music/c.mp3') == (0, None)
+    assert hist.plays('Music/d.mp3') == (1, 450)
+    assert 'Music/c.mp3' not in hist.play_count
+
+    fresh = history_index()
+    fresh.update(tmp_path, workers=1)
+    assert fresh.play_count == hist.play_count
+    assert fresh.last_played == hist.last_played
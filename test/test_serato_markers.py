@@ -0,0 +1,111 @@
+'''
+Tests for reading Serato tags from audio files
+
+pytest test/test_serato_markers.py
+'''
+
+import base64
+import struct
+
+from onya.dj.serial.serato_markers import extract, extract_all, marker_index, serato_markers
+
+
+def wrapped_b64(data):
+    # As Serato writes it: wrapped at 72 characters & unpadded
+    b64 = base64.b64encode(data).rstrip(b'=')
+    return b'\n'.join(b64[i:i + 72] for i in range(0, len(b64), 72))
+
+
+def markers2_payload():
+    data = b'\x01\x01'
+    for slot, (position, name) in enumerate([(1500, 'drop'), (60000, '')]):
+        entry = b'\x00' + struct.pack('>BI', slot, position) + b'\x00\xcc\x00\x00\x00\x00' + name.encode() + b'\x00'
+        data += b'CUE\x00' + struct.pack('>I', len(entry)) + entry
+    entry = struct.pack('>xBII4s4sB?', 0, 1000, 5000, b'\xff' * 4, b'\x00\x27\xaa\xe1', 0, False) + b'loop\x00'
+    data += b'LOOP\x00' + struct.pack('>I', len(entry)) + entry
+    data += b'BPMLOCK\x00' + struct.pack('>I', 1) + b'\x01' + b'\x00'
+    return b'\x01\x01' + wrapped_b64(data) + b'\x00'
+
+
+def beatgrid_payload():
+    return struct.pack('>BBI', 1, 0, 2) + struct.pack('>fI', 0.1, 16) + struct.pack('>ff', 7.5, 124.0) + b'\x00'
+
+
+def syncsafe(n):
+    return bytes([(n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f])
+
+
+def geob(desc, payload):
+    body = b'\x00application/octet-stream\x00\x00' + desc.encode() + b'\x00' + payload
+    return b'GEOB' + syncsafe(len(body)) + b'\x00\x00' + body
+
+
+def vorbis_value(desc, payload):
+    return wrapped_b64(b'application/octet-stream\x00\x00' + desc.encode() + b'\x00' + payload)
+
+
+def flac_with_comment(path, *comments):
+    vendor = b'test'
+    block = struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments))
+    for comment in comments:
+        block += struct.pack('<I', len(comment)) + comment
+    streaminfo = bytes([0]) + (34).to_bytes(3, byteorder='big') + b'\x00' * 34
+    path.write_bytes(b'fLaC' + streaminfo + bytes([0x84]) + len(block).to_bytes(3, byteorder='big') + block)
+
+
+def test_damaged_flac_comment(tmp_path):
+    bad = tmp_path / 'bad.flac'
+    flac_with_comment(bad, b'SERATO_MARKERS_V2=not*base64!')
+    markers = extract(str(bad))
+    assert isinstance(markers, serato_markers)
+    assert not len(markers.cue_positions)
+
+
+def test_damaged_file_doesnt_abort_batch(tmp_path):
+    bad = tmp_path / 'bad.flac'
+    flac_with_comment(bad, b'SERATO_MARKERS_V2=not*base64!')
+    # ID3 header claiming a frame larger than the tag
+    truncated = tmp_path / 'truncated.mp3'
+    truncated.write_bytes(b'ID3\x03\x00\x00\x00\x00\x00\x20GEOB\xff\xff\xff\xff\x00\x00')
+    results = extract_all(['bad.flac', 'truncated.mp3', 'missing.mp3'], root=str(tmp_path), workers=1)
+    assert isinstance(results['bad.flac'], serato_markers)
+    assert results['truncated.mp3'] is None
+    assert results['missing.mp3'] is None
+
+
+def test_unreadable_containers_not_taken_for_no_cues(tmp_path):
+    (tmp_path / 'song.m4a').write_bytes(b'\x00\x00\x00\x20ftypM4A \x00\x00\x00\x00' + b'\x00' * 32)
+    # FLAC whose Vorbis comment block is cut short
+    cut = tmp_path / 'cut.flac'
+    flac_with_comment(cut, b'SERATO_MARKERS_V2=AAAA')
+    cut.write_bytes(cut.read_bytes()[:-6])
+    # An MP3 with no ID3 tag at all just has no cues
+    (tmp_path / 'bare.mp3').write_bytes(b'\xff\xfb\x90\x00' + b'\x00' * 100)
+    results = extract_all(['song.m4a', 'cut.flac', 'bare.mp3'], root=str(tmp_path), workers=1)
+    ix = marker_index(results)
+    assert ix.unreadable == {'song.m4a', 'cut.flac'}
+    assert ix.no_cues == ix.no_beatgrid == {'bare.mp3'}
+
+
+def check_markers(markers):
+    assert list(markers.cue_slots) == [0, 1]
+    assert list(markers.cue_positions) == [1500, 60000]
+    assert list(markers.cue_names) == ['drop', '']
+    assert list(markers.loops) == [1000, 5000]
+    assert markers.bpm_locked
+    assert markers.beatgrid_bpm == 124.0
+    assert [round(p, 3) for p in markers.beatgrid] == [0.1, 7.5]
+
+
+def test_id3_markers(tmp_path):
+    frames = geob('Serato Markers2', markers2_payload()) + geob('Serato BeatGrid', beatgrid_payload()) + b'\x00' * 20
+    path = tmp_path / 'tagged.mp3'
+    path.write_bytes(b'ID3\x04\x00\x00' + syncsafe(len(frames)) + frames + b'\xff\xfb' + b'\x00' * 100)
+    check_markers(extract(str(path)))
+
+
+def test_flac_markers(tmp_path):
+    path = tmp_path / 'tagged.flac'
+    flac_with_comment(path, b'SERATO_MARKERS_V2=' + vorbis_value('Serato Markers2', markers2_payload()),
+                      b'SERATO_BEATGRID=' + vorbis_value('Serato BeatGrid', beatgrid_payload()))
+    check_markers(extract(str(path)))
@@ -0,0 +1,113 @@
+'''
+Tests for the HTTP/JSON query service, over a loopback connection
+
+pytest test/test_service.py
+'''
+
+import json
+import asyncio
+
+import pytest
+
+from onya.dj.service import service
+
+
+@pytest.fixture
+def svc(make_db):
+    svc = service(make_db(30))
+    svc.load()
+    return svc
+
+
+async def read_response(reader):
+    '''
+    Read one HTTP response. Return (status, headers, decoded JSON body)
+    '''
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1')
+        if line in ('\r\n', ''):
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if not size:
+                break
+            body += chunk[:-2]
+    else:
+        body = await reader.readexactly(int(headers['content-length']))
+    return status, headers, json.loads(body)
+
+
+def exchange(svc, *requests):
+    '''
+    Start the service on a loopback port, send raw requests on one connection &
+    return the responses, as from read_response
+    '''
+    async def _exchange():
+        server = await asyncio.start_server(svc.handle_client, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            responses = []
+            for req in requests:
+                writer.write(req.encode('latin-1'))
+                await writer.drain()
+                responses.append(await read_response(reader))
+            writer.close()
+            return responses
+    return asyncio.run(_exchange())
+
+
+def get(target, close=False):
+    return f'GET {target} HTTP/1.1\r\nHost: localhost\r\n' + ('Connection: close\r\n' if close else '') + '\r\n'
+
+
+def test_keep_alive_and_chunked_lists(svc):
+    (s1, h1, crates), (s2, h2, tracks), (s3, h3, found) = exchange(
+        svc, get('/crates'), get('/query?tbpm=91..92&limit=5'), get('/track?path=Music/a/track1.mp3', close=True))
+    assert (s1, s2, s3) == (200, 200, 200)
+    assert h1['transfer-encoding'] == 'chunked' and h1['connection'] == 'keep-alive'
+    assert crates == []
+    assert [ t['pfil'] for t in tracks ] == ['Music/a/track1.mp3', 'Music/a/track2.mp3']
+    assert h3['connection'] == 'close' and 'content-length' in h3
+    assert found['track']['tsng'] == 'Song 1' and found['crates'] == []
+
+
+def test_query_values_match_batch(svc):
+    '''Numeric-looking query string values still match text fields, as from batch JSON'''
+    _, _, tracks = exchange(svc, get('/query?tsng=Song%207'))[0]
+    assert [ t['pfil'] for t in tracks ] == ['Music/a/track7.mp3']
+    _, _, tracks = exchange(svc, get('/query?tkey=am&tbpm=94'))[0]
+    batch = svc.lib.answer('query', {'criteria': {'tkey': 'Am', 'tbpm': '94'}})
+    assert [ t['pfil'] for t in tracks ] == [ t['pfil'] for t in batch ] == ['Music/a/track4.mp3']
+    assert svc.lib.answer('query', {'criteria': {'tsng': 'Song 7'}}) == \
+        svc.lib.answer('query', {'criteria': {'tsng': 'song 7'}})
+
+
+def test_query_number_for_text_field(svc):
+    svc.lib.tracks[3]['tsng'] = '1999'
+    svc.lib._field_indexes.clear()
+    _, _, tracks = exchange(svc, get('/query?tsng=1999'))[0]
+    assert [ t['pfil'] for t in tracks ] == ['Music/a/track3.mp3']
+
+
+def test_errors(svc):
+    responses = exchange(svc, get('/reload'), get('/nope'), get('/crate?name=Nope'),
+                         get('/query?tbpm=1..x'), get('/search'),
+                         'GET /crates HTTP/1.1\r\nContent-Length: abc\r\n\r\n')
+    assert [ status for (status, _, _) in responses ] == [405, 404, 404, 400, 400, 400]
+    assert all('error' in body for (_, _, body) in responses)
+
+
+def test_reload(svc):
+    svc.lib.tracks.clear()
+    status, _, body = exchange(svc, 'POST /reload HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}')[0]
+    assert status == 200
+    assert body == {'tracks': 30, 'crates': 0, 'crate_errors': {}}
+    assert len(svc.lib.tracks) == 30
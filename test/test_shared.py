@@ -0,0 +1,112 @@
+'''
+Tests for publishing library snapshots to shared memory
+
+pytest test/test_shared.py
+'''
+
+import os
+import sys
+import json
+import math
+import uuid
+import subprocess
+
+import pytest
+
+from onya.dj.shared import attach, publisher, MISSING_BOOL, MISSING_CODE, MISSING_INT
+
+TRACKS = [
+    {'pfil': 'Music/b.mp3', 'tsng': 'Second', 'tbpm': 124, 'tlen': 181.5, 'bmis': False},
+    {'pfil': 'Music/a.mp3', 'tsng': 'First', 'tbpm': 98, 'tlen': 240.25, 'bmis': True},
+    {'pfil': 'Music/c.mp3'},
+]
+
+
+@pytest.fixture
+def pub():
+    p = publisher(f'onya-test-{uuid.uuid4().hex[:12]}')
+    yield p
+    p.close()
+
+
+def test_track_by_path(pub):
+    pub.publish(TRACKS)
+    snap = attach(pub.name)
+    assert len(snap) == 3
+    assert snap.track('Music/a.mp3') == TRACKS[1]
+    assert snap.track('Music/c.mp3') == TRACKS[2]
+    assert snap.track('Music/zzz.mp3') is None
+    assert snap.track('') is None
+    assert list(snap) == TRACKS
+    snap.close()
+
+
+def test_missing_values(pub):
+    pub.publish(TRACKS)
+    snap = attach(pub.name)
+    assert snap.column('bmis')[2] == MISSING_BOOL
+    assert snap.column('tbpm')[2] == MISSING_INT
+    assert math.isnan(snap.column('tlen')[2])
+    assert snap.column('tsng')[2] == MISSING_CODE
+    assert [ snap.value(f, 2) for f in ('bmis', 'tbpm', 'tlen', 'tsng') ] == [None] * 4
+    # False & 0 aren't taken for missing
+    assert snap.value('bmis', 0) is False
+    snap.close()
+
+
+def test_empty_track_list(pub):
+    assert pub.publish([]) == 1
+    snap = attach(pub.name)
+    assert len(snap) == 0 and snap.fields == []
+    assert list(snap) == []
+    assert snap.track('Music/a.mp3') is None
+    with pytest.raises(IndexError):
+        snap[0]
+    snap.close()
+
+
+def test_refresh(pub):
+    pub.publish(TRACKS)
+    snap = attach(pub.name)
+    assert snap.refresh() is snap
+    assert pub.publish(TRACKS[:1] + [{'pfil': 'Music/d.mp3', 'tsng': 'Fourth'}]) == 2
+    newer = snap.refresh()
+    assert (newer.version, len(newer)) == (2, 2)
+    assert newer.track('Music/d.mp3') == {'pfil': 'Music/d.mp3', 'tsng': 'Fourth'}
+    assert newer.track('Music/a.mp3') is None
+    # The old version stays readable until closed
+    assert snap.version == 1 and snap.track('Music/a.mp3') == TRACKS[1]
+    snap.close()
+    newer.close()
+
+
+CHILD = '''
+import sys, json
+from onya.dj.shared import attach
+snap = attach(sys.argv[1])
+print(json.dumps([snap.version, len(snap), snap.track('Music/a.mp3')]), flush=True)
+sys.stdin.readline()
+snap = snap.refresh()
+print(json.dumps([snap.version, len(snap), snap.track('Music/d.mp3')]), flush=True)
+snap.close()
+'''
+
+
+def test_attach_from_another_process(pub):
+    pub.publish(TRACKS)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    child = subprocess.Popen([sys.executable, '-c', CHILD, pub.name], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, text=True, env=env)
+    try:
+        assert json.loads(child.stdout.readline()) == [1, 3, TRACKS[1]]
+        pub.publish([{'pfil': 'Music/d.mp3', 'tbpm': 130}])
+        out, _ = child.communicate('\n', timeout=30)
+    finally:
+        if child.poll() is None:
+            child.kill()
+    assert json.loads(out) == [2, 1, {'pfil': 'Music/d.mp3', 'tbpm': 130}]
+    assert child.returncode == 0
+    # The child detaching leaves the snapshot in place for others
+    snap = attach(pub.name)
+    assert snap.version == 2
+    snap.close()
@@ -0,0 +1,33 @@
+'''
+Tests for metadata similarity search
+
+pytest test/test_similar.py
+'''
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from onya.dj.similar import similarity_index
+
+
+def tracks(n):
+    return [ {'pfil': f'Music/a/track{i}.mp3', 'tbpm': 120 + i % 10, 'tkey': ['Am', 'C', 'F#m'][i % 3],
+              'tgen': ['House', 'Techno'][i % 2], 'tlen': 200.0 + i, 'tlbl': f'Label {i % 4}'}
+             for i in range(n) ]
+
+
+@pytest.mark.parametrize('approximate', [False, True])
+def test_copy_of_track_excludes_itself(approximate):
+    index = similarity_index(tracks(200))
+    query = dict(index.tracks[17])
+    results = index.similar(query, k=5, approximate=approximate)
+    assert results
+    assert all(t['pfil'] != query['pfil'] for (t, _) in results)
+    assert index.similar(index.tracks[17], k=5, approximate=approximate) == results
+
+
+@pytest.mark.parametrize('approximate', [False, True])
+def test_empty_index(approximate):
+    index = similarity_index([])
+    assert index.similar({'pfil': 'x.mp3', 'tbpm': 120}, approximate=approximate) == []